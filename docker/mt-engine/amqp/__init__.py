@@ -44,6 +44,23 @@ def setup_argparser_common(p):
     
     p.add_argument('--parallel', '-n', dest='parallel', type=int,
                    default=os.environ.get('PARALLEL',1),
-                   help="messages to process in parallel "
-                   "(or set env variable PARALLEL)")
+                   help="messages to translate in parallel; also the minimum "
+                   "prefetch count (or set env variable PARALLEL)")
+
+    p.add_argument('--prefetch-count', type=int,
+                   default=os.environ.get('PREFETCH_COUNT',1),
+                   help="max. number of unacknowledged messages delivered "
+                   "to the worker (or set env variable PREFETCH_COUNT)")
+
+    p.add_argument('--publisher-confirms', action='store_true',
+                   default=bool(os.environ.get('PUBLISHER_CONFIRMS','')),
+                   help="acknowledge a request only once the broker has "
+                   "confirmed its replies (or set env variable "
+                   "PUBLISHER_CONFIRMS)")
+
+    p.add_argument('--ack-interval', type=float,
+                   default=os.environ.get('ACK_INTERVAL',0),
+                   help="seconds to collect finished requests before "
+                   "acknowledging them together (or set env variable "
+                   "ACK_INTERVAL)")
     
@@ -10,6 +10,7 @@ import functools
 import logging
 import pika
 import regex
+from collections import defaultdict
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
                 '-35s %(lineno) -5d: %(message)s')
@@ -17,11 +18,17 @@ logger = logging.getLogger(__name__)
 
 class AMQP_Worker(object):
     def __init__(self, amqp_url, queue, exchange='', exchange_type='topic',
-                 routing_key='', prefetch_count=1):
+                 routing_key='', prefetch_count=1, confirm_delivery=False,
+                 ack_interval=0):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param bool confirm_delivery: Put the channel into publisher confirm
+            mode and acknowledge a message only once the broker has
+            confirmed all replies published for it
+        :param float ack_interval: Seconds to wait for more finished
+            messages before acknowledging them together (0: right away)
 
         """
         self._connection = None
@@ -33,7 +40,24 @@ class AMQP_Worker(object):
         self._exchange_type = exchange_type
         self._queue = queue
         self._prefetch_count = prefetch_count
-        
+        self._confirm_delivery = confirm_delivery
+        self._ack_interval = ack_interval
+        self.reset_delivery_state()
+
+    def reset_delivery_state(self):
+        """Forget about deliveries and publications on the previous channel;
+        delivery tags and publish sequence numbers start over on each
+        channel, and the broker redelivers unacknowledged messages.
+
+        """
+        self._unsettled = set()    # delivery tags of messages not yet (n)acked
+        self._finished = set()     # ... of those that we are done with
+        self._rejected = set()     # ... of those nacked because a reply was lost
+        self._replies_pending = defaultdict(int) # delivery tag -> unconfirmed replies
+        self._unconfirmed = {}     # publish sequence number -> delivery tag
+        self._publish_seq = 0
+        self._ack_timer = None
+
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
         When the connection is established, the on_connection_open method
@@ -125,8 +149,12 @@ class AMQP_Worker(object):
         """
         logger.info('Channel opened')
         self._channel = channel
+        self.reset_delivery_state()
         if self._prefetch_count:
             channel.basic_qos(prefetch_count=self._prefetch_count)
+        if self._confirm_delivery:
+            logger.info('Enabling publisher confirms')
+            channel.confirm_delivery(ack_nack_callback=self.on_delivery_confirmation)
         self.add_on_channel_close_callback()
         if len(self._exchange):
             self.setup_exchange(self._exchange)
@@ -243,9 +271,17 @@ class AMQP_Worker(object):
         logger.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume\
-                             (on_message_callback=self.on_message,
+                             (on_message_callback=self.on_delivery,
                               queue=self._queue)
 
+    def on_delivery(self, channel, basic_deliver, properties, body):
+        """Keep track of the delivery tag, so that acknowledgements can be
+        batched, and pass the message on to on_message.
+
+        """
+        self._unsettled.add(basic_deliver.delivery_tag)
+        self.on_message(channel, basic_deliver, properties, body)
+
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
         for some reason. If RabbitMQ does cancel the consumer,
@@ -285,15 +321,141 @@ class AMQP_Worker(object):
                     basic_deliver.delivery_tag, properties.app_id, body)
         self.acknowledge_message(basic_deliver.delivery_tag)
 
+    def publish(self, channel, exchange, routing_key, body, properties=None,
+                delivery_tag=None):
+        """Publish a message. In publisher confirm mode, the broker's
+        confirmation is tracked; the message with /delivery_tag/ (the
+        request that this is a reply to) won't be acknowledged before it
+        arrives. Replies to a request that has already been requeued are
+        not published (they would arrive twice); returns False then.
+
+        :param pika.channel.Channel channel: The channel to publish on
+        :param int delivery_tag: Delivery tag of the request, if any
+        :rtype: bool
+
+        """
+        if channel is self._channel and delivery_tag in self._rejected:
+            logger.info('Not publishing reply to requeued message %s',
+                        delivery_tag)
+            return False
+        channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                              body=body, properties=properties)
+        if self._confirm_delivery and channel is self._channel:
+            self._publish_seq += 1
+            self._unconfirmed[self._publish_seq] = delivery_tag
+            if delivery_tag is not None:
+                self._replies_pending[delivery_tag] += 1
+        return True
+
+    def on_delivery_confirmation(self, method_frame):
+        """Invoked by pika when RabbitMQ confirms (Basic.Ack) or rejects
+        (Basic.Nack) published messages. Requests whose replies are all
+        confirmed are acknowledged; a request with a lost reply is rejected
+        and requeued, so that it is processed again.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        method = method_frame.method
+        confirmed = type(method).__name__ == 'Ack'
+        if method.multiple:
+            seqs = [s for s in self._unconfirmed if s <= method.delivery_tag]
+        else:
+            seqs = [method.delivery_tag]
+        for seq in seqs:
+            delivery_tag = self._unconfirmed.pop(seq, None)
+            if delivery_tag not in self._replies_pending:
+                continue # not a reply, or to a request already rejected
+            self._replies_pending[delivery_tag] -= 1
+            if not confirmed:
+                logger.warning('Reply to message %s was lost; requeueing it',
+                               delivery_tag)
+                if delivery_tag in self._finished:
+                    self._finished.discard(delivery_tag)
+                else: # still being processed
+                    self._rejected.add(delivery_tag)
+                self._unsettled.discard(delivery_tag)
+                del self._replies_pending[delivery_tag]
+                self._channel.basic_nack(delivery_tag, requeue=True)
+            elif not self._replies_pending[delivery_tag]:
+                del self._replies_pending[delivery_tag]
+                if delivery_tag in self._finished:
+                    self.schedule_acks()
+        logger.info('%d published messages awaiting confirmation',
+                    len(self._unconfirmed))
+
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
-        Basic.Ack RPC method for the delivery tag.
+        Basic.Ack RPC method for the delivery tag: once all replies
+        published for it are confirmed (in publisher confirm mode), and
+        together with other finished messages where possible.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+
+        """
+        if delivery_tag in self._rejected:
+            self._rejected.discard(delivery_tag)
+            return
+        self._finished.add(delivery_tag)
+        if not self._replies_pending.get(delivery_tag):
+            self.schedule_acks()
+
+    def reject_message(self, delivery_tag, requeue=False):
+        """Reject the message delivery (Basic.Nack), e.g. because processing
+        it failed. Unless /requeue/ is true, the broker drops or
+        dead-letters it.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
-        logger.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        if delivery_tag in self._rejected:
+            # already requeued; nacking it again would close the channel
+            self._rejected.discard(delivery_tag)
+            return
+        logger.info('Rejecting message %s', delivery_tag)
+        self._unsettled.discard(delivery_tag)
+        self._finished.discard(delivery_tag)
+        self._replies_pending.pop(delivery_tag, None)
+        self._channel.basic_nack(delivery_tag, requeue=requeue)
+        self.schedule_acks() # messages held back by this one
+
+    def schedule_acks(self):
+        """Send acknowledgements now, or after ack_interval seconds."""
+        if not self._ack_interval:
+            self.send_acks()
+        elif self._ack_timer is None:
+            self._ack_timer = self._connection.ioloop.call_later\
+                              (self._ack_interval, self.on_ack_timer)
+
+    def on_ack_timer(self):
+        self._ack_timer = None
+        self.send_acks()
+
+    def send_acks(self):
+        """Acknowledge all finished messages (with confirmed replies). Those
+        delivered before the oldest message still being processed are
+        acknowledged with a single Basic.Ack (multiple=True), the others one
+        by one, so that a long message doesn't hold up the prefetch window.
+
+        """
+        if self._channel is None or not self._channel.is_open:
+            return
+        ready = [t for t in self._finished if not self._replies_pending.get(t)]
+        if not ready:
+            return
+        busy = self._unsettled.difference(ready)
+        oldest = min(busy) if busy else None
+        settled = [t for t in ready if oldest is None or t < oldest]
+        if settled:
+            last = max(settled)
+            logger.info('Acknowledging %d messages up to %s',
+                        len(settled), last)
+            self._channel.basic_ack(last, multiple=len(settled) > 1)
+        for t in sorted(set(ready).difference(settled)):
+            logger.info('Acknowledging message %s', t)
+            self._channel.basic_ack(t)
+        self._unsettled.difference_update(ready)
+        self._finished.difference_update(ready)
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
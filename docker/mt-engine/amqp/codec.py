@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Encoding of message bodies: JSON (the default) or MessagePack, optionally
+compressed with zlib, gzip or (if the zstandard module is installed) zstd.
+
+A requester asks for a more compact reply with the message headers
+  acceptContentType:     e.g. "application/msgpack, application/json"
+  acceptContentEncoding: e.g. "zstd, zlib"
+listing what it understands in order of preference. The worker uses the
+first one it supports and states its choice in the content_type and
+content_encoding properties of the reply. Incoming messages are decoded
+according to their own content_type and content_encoding.
+"""
+
+import json, zlib, gzip
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',',':')).encode('utf8')
+
+def _json_loads(body):
+    return json.loads(body.decode('utf8'))
+
+# content type -> (serialize, deserialize)
+SERIALIZERS = { JSON: (_json_dumps, _json_loads) }
+if msgpack is not None:
+    SERIALIZERS[MSGPACK] = (lambda obj: msgpack.packb(obj, use_bin_type=True),
+                            lambda body: msgpack.unpackb(body, raw=False))
+    pass
+
+# content encoding -> (compress, decompress)
+COMPRESSORS = { 'zlib': (zlib.compress, zlib.decompress),
+                'gzip': (gzip.compress, gzip.decompress) }
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (lambda body: zstandard.ZstdCompressor().compress(body),
+                           lambda body: zstandard.ZstdDecompressor()\
+                           .decompressobj().decompress(body))
+    pass
+
+def negotiate(accept, supported, default=None):
+    """The first item of comma-separated list /accept/ that is in
+    /supported/, or /default/."""
+    for choice in (accept or '').split(','):
+        choice = choice.strip().lower()
+        if choice in supported:
+            return choice
+        pass
+    return default
+
+def encode(obj, content_type=None, content_encoding=None):
+    """Serialize /obj/ to bytes (JSON unless /content_type/ says otherwise)
+    and compress them if /content_encoding/ is given."""
+    body = SERIALIZERS[content_type or JSON][0](obj)
+    if content_encoding:
+        body = COMPRESSORS[content_encoding][0](body)
+    return body
+
+def decode(body, content_type=None, content_encoding=None):
+    """Inverse of encode(). Content encodings other than the compression
+    methods above (e.g. a charset) leave the body as it is; content types
+    other than MessagePack are read as JSON."""
+    if content_encoding and content_encoding.lower() in COMPRESSORS:
+        body = COMPRESSORS[content_encoding.lower()][1](body)
+    if content_type and content_type.lower() == MSGPACK:
+        return SERIALIZERS[MSGPACK][1](body)
+    return _json_loads(body)
@@ -2,14 +2,17 @@
 # This is a pika-based worker. It's not the most effective way of interacting
 # with an AMQP broker, but the easiest to understand.
 
-import sys, os, amqp, pika, time, logging, json
+import sys, os, amqp, pika, time, logging, json, functools
 import task_handler
-from task_handler import MessageHandler, DocumentTranslator
+from concurrent.futures import ThreadPoolExecutor
+from task_handler import MessageHandler, DocumentTranslator, MicroBatcher
 from argparse import ArgumentParser
 from pika.exceptions import *
 from retry import retry
 
 from amqp.async_worker import AMQP_Worker as BasicWorker
+from amqp import codec
+from pipeline import StagedPipeline
 logger = logging.getLogger(__name__)
 
 class Worker(BasicWorker):
@@ -18,47 +21,281 @@ class Worker(BasicWorker):
         queue = opts.request_queue
         exchange = opts.request_exchange
         exchange_type='topic'
-        prefetch_count = getattr(opts,'prefetch_count',1)
+        # translate up to /parallel/ messages at a time, each with its own
+        # connection to marian; the broker must deliver at least that many
+        parallel = max(1, getattr(opts,'parallel',1))
+        prefetch_count = max(getattr(opts,'prefetch_count',1), parallel)
+        if getattr(opts,'connections',1) < parallel:
+            logger.info("Using %d connections to each marian server."%parallel)
+            opts.connections = parallel
         routing_key = '' # what is this used for when consuming messages?
         super().__init__(url,queue,exchange,exchange_type,
-                         routing_key,prefetch_count)
+                         routing_key,prefetch_count,
+                         getattr(opts,'publisher_confirms',False),
+                         getattr(opts,'ack_interval',0))
         reply_headers = dict(resultProducerName='SUMMA-MT')
         self.reply_properties = pika.BasicProperties(headers=reply_headers)
         self.translate = DocumentTranslator(opts)
+        self.exit_code = 0
+
+        # translation happens outside the ioloop, so that heartbeats and
+        # other deliveries are served while long documents are translated
+        self.executor = ThreadPoolExecutor(max_workers=parallel,
+                                           thread_name_prefix="translate")
+
+        # preprocessing, decoding and postprocessing of consecutive
+        # messages in parallel
+        self.pipeline = None
+        depth = getattr(opts,'pipeline_depth',0)
+        if depth:
+            # deliveries are bounded by the prefetch count, so submitting
+            # a message never blocks the ioloop if the queues are big enough
+            self.pipeline = StagedPipeline(self.translate.stages(),
+                                           max(depth, prefetch_count))
+
+        # cross-document batching
+        self.batcher = None
+        self._batch_timer = None
+        max_wait = getattr(opts,'batch_max_wait',0)
+        if max_wait and self.pipeline:
+            logger.warning("--batch-max-wait is ignored with --pipeline-depth.")
+        elif max_wait:
+            if prefetch_count == 1:
+                logger.warning("Batching across messages is pointless with "
+                               "a prefetch count of 1.")
+            self.batcher = MicroBatcher(self.translate.translate.decode, max_wait,
+                                        getattr(opts,'batch_max_tokens',2000))
+        if self.translate.part_size and (self.pipeline or self.batcher):
+            logger.warning("--partial-results is ignored with --pipeline-depth "
+                           "or --batch-max-wait.")
+        return
+
+    def start_consuming(self):
+        """Start consuming only once the translator is ready (model files
+        may still be being built), so that requests go to other workers in
+        the meantime."""
+        self._start_when_ready(self._channel)
+        return
+
+    def _start_when_ready(self, channel):
+        if channel is not self._channel or not channel.is_open:
+            return # reconnected in the meantime; start_consuming runs again
+        try:
+            ready = self.translate.translate.wait_ready(0)
+        except Exception: # the translator has logged the details
+            logger.error("Could not set up pre-/postprocessing. Shutting down.")
+            self.exit_code = 1
+            self._closing = True # don't reconnect
+            self.translate.translate.stop()
+            self.close_connection()
+            return
+        if not ready:
+            logger.info("Waiting for the translator to be ready.")
+            self._connection.ioloop.call_later\
+                (1, functools.partial(self._start_when_ready, channel))
+            return
+        super().start_consuming()
         return
 
-    def send_reply(self, ch, properties, metadata, translation):
+    def token_format(self, properties):
+        """The token format the requester asked for, if we support it."""
+        return codec.negotiate(properties.headers.get('acceptTokenFormat'),
+                               task_handler.SENTENCE_ENCODERS)
+
+    def reply_format(self, properties):
+        """Content type and encoding of the reply, as negotiated through the
+        request's headers, and the properties to publish it with."""
+        headers = properties.headers
+        content_type = codec.negotiate(headers.get('acceptContentType'),
+                                       codec.SERIALIZERS)
+        content_encoding = codec.negotiate(headers.get('acceptContentEncoding'),
+                                           codec.COMPRESSORS)
+        token_format = self.token_format(properties)
+        if not (content_type or content_encoding or token_format):
+            return None, None, self.reply_properties
+        reply_headers = dict(self.reply_properties.headers)
+        if token_format:
+            reply_headers['tokenFormat'] = token_format
+        props = pika.BasicProperties(headers=reply_headers,
+                                     content_type=content_type or codec.JSON,
+                                     content_encoding=content_encoding)
+        return content_type, content_encoding, props
+
+    def send_reply(self, ch, basic_deliver, properties, metadata, translation,
+                   result_type='finalResult'):
         rkeys = properties.headers['replyToRoutingKeys']
         exchange = properties.headers['replyToExchange']
         reply = { 'resultData' : translation,
-                  'resultType' : 'finalResult',
+                  'resultType' : result_type,
                   'taskMetadata': metadata }
+        content_type, content_encoding, props = self.reply_format(properties)
+        if props is self.reply_properties:
+            body = json.dumps(reply)
+        else:
+            body = codec.encode(reply, content_type, content_encoding)
         try: # sending the reply
-            ch.basic_publish(exchange=exchange,routing_key=rkeys['finalResult'],
-                             properties=self.reply_properties,
-                             body=json.dumps(reply,'utf8'))
-            logger.info("Published result to %s:%s"%
-                        (exchange,rkeys['finalResult']))
+            if self.publish(ch, exchange, rkeys[result_type], body,
+                            props, basic_deliver.delivery_tag):
+                logger.info("Published %s to %s:%s"%
+                            (result_type,exchange,rkeys[result_type]))
         except: # annouce failure and raise
             logger.info("Exception: %r"%sys.exc_info()[0])
             logger.info("Could not deliver results.")
             raise
         
         return
-            
+
+    def send_partial(self, ch, basic_deliver, properties, metadata, result):
+        """Publish part of a translation (runs on the ioloop)."""
+        if ch is not self._channel or not ch.is_open:
+            return # the final result won't be delivered either
+        self.send_reply(ch, basic_deliver, properties, metadata, result,
+                        'partialResult')
+        return
+
+    def partial_result_handler(self, ch, basic_deliver, properties, metadata):
+        """Callback for DocumentTranslator that publishes partial results
+        from the translating thread via the ioloop, or None if the
+        requester doesn't want any."""
+        if not self.translate.part_size or \
+           'partialResult' not in properties.headers['replyToRoutingKeys']:
+            return None
+        def on_partial(instance, offset, sentences):
+            body = dict(instance['body'], sentences=sentences)
+            result = { 'instances': [dict(instance, body=body)],
+                       'sentenceOffset': offset }
+            self.on_ioloop(self.send_partial, ch, basic_deliver, properties,
+                           metadata, result)
+            return
+        return on_partial
+
     def on_message(self, ch, basic_deliver, properties, body):
         logger.info("Got message: #%s"%basic_deliver.delivery_tag)
-        msg_body = json.loads(body.decode('utf8'))
+        msg_body = codec.decode(body, properties.content_type,
+                                properties.content_encoding)
         payload = msg_body['taskData']
         metadata = msg_body['taskMetadata']
+        if self.pipeline:
+            self.add_to_pipeline(ch, basic_deliver, properties, payload, metadata)
+            return
+        if self.batcher is not None:
+            self.add_to_batch(ch, basic_deliver, properties, payload, metadata)
+            return
         start = time.time()
-        translation = self.translate(payload)
-        logger.info("Translation took %.2f sec."%(time.time()-start))
-        self.send_reply(ch, properties, metadata, translation)
+        def on_translated(future):
+            try:
+                translation = future.result()
+            except Exception as e:
+                self.fail_message(ch, basic_deliver, e)
+                return
+            logger.info("Translation of message #%s took %.2f sec."
+                        %(basic_deliver.delivery_tag, time.time()-start))
+            self.finish_message(ch, basic_deliver, properties,
+                                metadata, translation)
+            return
+        on_partial = self.partial_result_handler(ch, basic_deliver,
+                                                 properties, metadata)
+        future = self.executor.submit(self.translate, payload, on_partial,
+                                      self.token_format(properties))
+        future.add_done_callback(functools.partial(self.on_ioloop, on_translated))
+        return
+
+    def on_ioloop(self, func, *args):
+        """Have /func/ called with /args/ on the ioloop's thread (pika is
+        not thread-safe)."""
+        self._connection.ioloop.add_callback_threadsafe\
+            (functools.partial(func, *args))
+        return
+
+    def add_to_pipeline(self, ch, basic_deliver, properties, payload, metadata):
+        """Hand the document to the translation pipeline; the reply is sent
+        from the ioloop once the translation is done."""
+        start = time.time()
+        def on_translated(future):
+            try:
+                translation = future.result()
+            except Exception as e:
+                self.fail_message(ch, basic_deliver, e)
+                return
+            logger.info("Translation of message #%s took %.2f sec. "
+                        "(queue depths: %r)"%(basic_deliver.delivery_tag,
+                                              time.time()-start,
+                                              self.pipeline.depths()))
+            self.finish_message(ch, basic_deliver, properties,
+                                metadata, translation)
+            return
+        future = self.pipeline.submit((payload, self.token_format(properties)))
+        future.add_done_callback(functools.partial(self.on_ioloop, on_translated))
+        return
+
+    def add_to_batch(self, ch, basic_deliver, properties, payload, metadata):
+        """Preprocess the document and queue its sentences for translation
+        together with those of other messages. Pre- and postprocessing and
+        decoding run on the executor; the batcher itself is only used on
+        the ioloop."""
+        start = time.time()
+        token_format = self.token_format(properties)
+        def on_error(e): # called in a worker thread
+            self.on_ioloop(self.fail_message, ch, basic_deliver, e)
+            return
+        def on_prepared(future):
+            try:
+                jobs, sources = future.result()
+            except Exception as e:
+                self.fail_message(ch, basic_deliver, e)
+                return
+            def on_done(translations): # called in a worker thread
+                translation = self.translate.finish(payload, jobs, translations,
+                                                    token_format)
+                logger.info("Translation of message #%s took %.2f sec."
+                            %(basic_deliver.delivery_tag, time.time()-start))
+                self.on_ioloop(self.finish_message, ch, basic_deliver,
+                               properties, metadata, translation)
+                return
+            if self.batcher.add(sources, on_done, on_error):
+                self.flush_batch()
+            elif self._batch_timer is None:
+                self._batch_timer = self._connection.ioloop.call_later\
+                                    (self.batcher.max_wait, self.on_batch_timer)
+            return
+        future = self.executor.submit(self.translate.prepare, payload)
+        future.add_done_callback(functools.partial(self.on_ioloop, on_prepared))
+        return
+
+    def on_batch_timer(self):
+        self._batch_timer = None
+        self.executor.submit(self.batcher.run, self.batcher.take())
+        return
+
+    def flush_batch(self):
+        if self._batch_timer is not None:
+            self._connection.ioloop.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        self.executor.submit(self.batcher.run, self.batcher.take())
+        return
+
+    def fail_message(self, ch, basic_deliver, error):
+        """Reject a message that could not be translated. It isn't
+        requeued, since it would most likely fail again."""
+        logger.error("Translation of message #%s failed: %r"
+                     %(basic_deliver.delivery_tag, error), exc_info=error)
+        if ch is not self._channel or not ch.is_open:
+            return # the broker redelivers it
+        self.reject_message(basic_deliver.delivery_tag)
+        return
+
+    def finish_message(self, ch, basic_deliver, properties, metadata, translation):
+        if ch is not self._channel or not ch.is_open:
+            # the broker redelivers unacknowledged messages
+            logger.warning("Channel closed while message #%s was being "
+                           "translated; dropping the result."
+                           %basic_deliver.delivery_tag)
+            return
+        self.send_reply(ch, basic_deliver, properties, metadata, translation)
 
-        try: # acknowledge the message
+        try: # acknowledge the message (once the reply is confirmed)
             self.acknowledge_message(basic_deliver.delivery_tag)
-            logger.info("Acknowledged message #%r"%basic_deliver.delivery_tag)
+            logger.info("Finished message #%r"%basic_deliver.delivery_tag)
         except Exception:
             logger.info("Exception: %r"%sys.exc_info()[0])
             logger.info("Could not acknowledge message.")
@@ -84,6 +321,7 @@ if __name__ == "__main__":
         W.run()
     except KeyboardInterrupt:
         W.stop()
+    sys.exit(W.exit_code)
 
 # logger = logging.getLogger(__name__)
 
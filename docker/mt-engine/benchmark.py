@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for components of the MT engine.
+
+  ./benchmark.py srx -l de < paragraphs.txt
+     compare the output and speed of the in-process SRX sentence splitter
+     against Eserix (input: one paragraph per line)
+
+  ./benchmark.py bucketing --mini-batch-sentences 32 < documents.txt
+     translation speed with and without sorting sentences into mini-batches
+     by length (input: one paragraph per line, blank lines between
+     documents)
+
+  ./benchmark.py documents --sentences 5000
+     overhead of DocumentTranslator's handling of (large) AMQP documents,
+     with a stand-in for the translator, against the former deep-copying
+     implementation (input: a synthetic document, or --document FILE)
+"""
+import sys, os, time, logging, json, copy
+logger = logging.getLogger(__name__)
+
+mydir = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(mydir,"summa_mt"))
+from argparse import ArgumentParser
+
+def timed(func, items):
+    start = time.time()
+    results = [func(x) for x in items]
+    return results, time.time() - start
+
+def report(name, elapsed, count, unit):
+    print("%-20s %8.3f sec. %10.1f %s/sec."
+          %(name, elapsed, count/elapsed if elapsed else 0, unit))
+    return
+
+def bench_srx(opts):
+    import split_sentences
+    from split_sentences import Eserix, EserixSession
+    from srx import SRXSplitter
+
+    paragraphs = [line.strip() for line in sys.stdin if line.strip()]
+    if opts.limit: paragraphs = paragraphs[:opts.limit]
+    rules = opts.rules or split_sentences.ESERIX_RULES
+
+    start = time.time()
+    srx = SRXSplitter(opts.lang, rules)
+    print("SRX rules compiled in %.3f sec."%(time.time() - start))
+    srx_out, srx_time = timed(srx, paragraphs)
+    splitters = [("eserix", Eserix(opts.lang, rules=rules)),
+                 ("eserix-persistent", EserixSession(opts.lang, rules=rules))]
+
+    report("srx", srx_time, len(paragraphs), "paragraphs")
+    for name, ssplit in splitters:
+        out, elapsed = timed(ssplit, paragraphs)
+        report(name, elapsed, len(paragraphs), "paragraphs")
+        same = sum(1 for a,b in zip(srx_out,out) if a == b)
+        print("%-20s %d of %d paragraphs split identically (%.1f%%)"
+              %("", same, len(paragraphs), 100.*same/max(1,len(paragraphs))))
+        if opts.show_diffs:
+            for p,a,b in zip(paragraphs,srx_out,out):
+                if a != b:
+                    print("\nPARAGRAPH: %s\n  SRX:    %s\n  %s: %s"
+                          %(p, ' || '.join(a), name.upper(), ' || '.join(b)))
+                    pass
+                pass
+            pass
+        if hasattr(ssplit,'close'): ssplit.close()
+        pass
+    return
+
+def read_documents(stream):
+    docs = [[]]
+    for line in stream:
+        line = line.strip()
+        if len(line): docs[-1].append(line)
+        elif len(docs[-1]): docs.append([])
+        pass
+    return [d for d in docs if len(d)]
+
+def bench_bucketing(opts):
+    import marian
+    docs = read_documents(sys.stdin)
+    if opts.limit: docs = docs[:opts.limit]
+    if not (opts.mini_batch_sentences or opts.mini_batch_tokens):
+        # we need mini-batches without sorting, too
+        opts.mini_batch_sentences = marian.SORTED_MINI_BATCH_SENTENCES
+    opts.cache_size = 0
+    opts.translation_memory = None
+    translate = marian.Translator(opts)
+    try:
+        # warm up (model loading, first requests)
+        for d in docs[:2]: translate(d)
+        outputs = {}
+        for sort in [False, True]:
+            translate.pipeline.sort_by_length = sort
+            start = time.time()
+            for r in range(opts.repeat):
+                outputs[sort] = [translate(d) for d in docs]
+                pass
+            elapsed = (time.time() - start) / opts.repeat
+            nsents = sum(len(t) for t in outputs[sort])
+            report("sorted" if sort else "original order",
+                   elapsed, nsents, "sentences")
+            pass
+        same = sum(1 for a,b in zip(outputs[False],outputs[True]) if a == b)
+        print("%d of %d documents translated identically."%(same, len(docs)))
+    finally:
+        translate.stop()
+    return
+
+class EchoTranslator:
+    """Stand-in for marian.Translator that 'translates' by echoing."""
+    def __init__(self, trglang):
+        self.trglang = trglang
+        return
+
+    def __call__(self, text):
+        return list(text)
+    pass
+
+def synthetic_document(instances, sentences, tokens, lang):
+    from task_handler import encode_sentence
+    words = ["word%d"%k for k in range(997)]
+    def sentence(k):
+        return encode_sentence(" ".join(words[(k*tokens + n) % len(words)]
+                                        for n in range(tokens)) + " </p>")
+    return { 'instances' : [ { 'metadata' : { 'language' : lang,
+                                              'instanceId' : "i%d"%i },
+                               'body' : { 'sentences' :
+                                          [sentence(i*sentences + k)
+                                           for k in range(sentences)] } }
+                             for i in range(instances) ] }
+
+def legacy_translate(translator, document):
+    """DocumentTranslator.__call__ before documents were shared: deep
+    copies of the instances, extended in place."""
+    from task_handler import extract_text, encode_translation
+    jobs = [copy.deepcopy(i) for i in document['instances']
+            if i['metadata']['language'] == translator.trglang]
+    for j in jobs:
+        pars = [extract_text(s) for s in j['body']['sentences']]
+        sents = [s for p in pars for s in p]
+        j['body']['sentences'] = encode_translation(translator(sents))
+        pass
+    document['instances'].extend(jobs)
+    return document
+
+def bench_documents(opts):
+    from task_handler import DocumentTranslator
+    if opts.document:
+        document = json.load(open(opts.document))
+        lang = document['instances'][0]['metadata']['language']
+    else:
+        lang = 'en'
+        document = synthetic_document(opts.instances, opts.sentences,
+                                      opts.tokens, lang)
+    ntokens = sum(len(s['tokens']) for i in document['instances']
+                  for s in i['body']['sentences'])
+    print("Document: %d instances, %d tokens, %.1f MB as JSON"
+          %(len(document['instances']), ntokens,
+            len(json.dumps(document))/1e6))
+
+    echo = EchoTranslator(lang)
+    translate = DocumentTranslator(None, echo)
+    # the legacy version modifies its input
+    inputs = [copy.deepcopy(document) for r in range(opts.repeat)]
+    start = time.time()
+    for d in inputs:
+        legacy = legacy_translate(echo, d)
+    report("deepcopy", (time.time() - start)/opts.repeat, ntokens, "tokens")
+    for token_format in ['dict', 'array']:
+        start = time.time()
+        for r in range(opts.repeat):
+            result = translate(document, token_format=token_format)
+        report("shared (%s)"%token_format, (time.time() - start)/opts.repeat,
+               ntokens, "tokens")
+        if token_format == 'dict':
+            print("%-20s results %s"%("", "identical" if result == legacy
+                                      else "DIFFER"))
+        pass
+    return
+
+def parse_arguments(args=sys.argv[1:]):
+    p = ArgumentParser()
+    p.add_argument("-v", "--verbose", const='INFO', default='WARN',nargs='?')
+    sub = p.add_subparsers(dest='benchmark')
+    sub.required = True
+
+    s = sub.add_parser('srx', help="SRX sentence splitter vs. Eserix")
+    s.add_argument("-l", dest="lang", default='en', help="language")
+    s.add_argument("--rules", help="SRX rules file (default: Eserix's)")
+    s.add_argument("--limit", type=int, default=0,
+                   help="max. number of paragraphs to use")
+    s.add_argument("--show-diffs", action='store_true',
+                   help="print paragraphs that are split differently")
+    s.set_defaults(func=bench_srx)
+
+    # needs no translator, hence no marian
+    s = sub.add_parser('documents', help="document handling overhead")
+    s.add_argument("--document", help="JSON file with a document "
+                   "(default: a synthetic one)")
+    s.add_argument("--instances", type=int, default=1,
+                   help="number of instances of the synthetic document")
+    s.add_argument("--sentences", type=int, default=2000,
+                   help="number of sentences per instance")
+    s.add_argument("--tokens", type=int, default=25,
+                   help="number of tokens per sentence")
+    s.add_argument("--repeat", type=int, default=5,
+                   help="number of times to process the document")
+    s.set_defaults(func=bench_documents)
+
+    try: # marian.py insists on finding the marian-server executable
+        import marian
+    except Exception as e:
+        logger.warning("Translation benchmarks unavailable: %s"%e)
+        marian = None
+        pass
+    if marian:
+        s = sub.add_parser('bucketing', help="length-sorted mini-batches")
+        marian.setup_argparser(s)
+        s.add_argument("--limit", type=int, default=0,
+                       help="max. number of documents to use")
+        s.add_argument("--repeat", type=int, default=1,
+                       help="number of times to translate each document")
+        s.set_defaults(func=bench_bucketing)
+        pass
+    return p.parse_args(args)
+
+if __name__ == "__main__":
+    opts = parse_arguments()
+    logging.basicConfig(level=opts.verbose,format="%(levelname)s %(message)s")
+    opts.func(opts)
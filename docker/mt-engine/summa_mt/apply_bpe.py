@@ -21,6 +21,14 @@ import io
 import argparse
 import re
 import warnings
+import heapq
+import hashlib
+import tempfile
+import multiprocessing
+from collections import deque
+
+from cache import LRUCache
+from mmap_table import MMapTable, build
 
 # hack for python2/3 compatibility
 from io import open
@@ -28,7 +36,30 @@ argparse.open = open
 
 class BPE(object):
 
-    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None):
+    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None, cache_size=0):
+
+        if isinstance(codes, MMapTable):
+            # compiled with compile_codes()
+            if int(codes['\0merges']) != merges:
+                raise ValueError('{0} was compiled for merges={1}, not {2}'.format(
+                    codes.path, codes['\0merges'], merges))
+            self.version = tuple(int(x) for x in codes['\0version'].split('.'))
+            self.bpe_codes = CodesTable(codes)
+            self.bpe_codes_reverse = ReverseCodesTable(codes)
+        else:
+            self._read_codes(codes, merges)
+
+        self.separator = separator
+
+        self.vocab = vocab
+
+        self.glossaries = glossaries if glossaries else []
+        self.glossary_matcher = Glossaries(self.glossaries)
+
+        # segmentations of words seen so far (cache_size 0: unbounded)
+        self.cache = LRUCache(cache_size)
+
+    def _read_codes(self, codes, merges):
 
         codes.seek(0)
         offset=1
@@ -55,13 +86,55 @@ class BPE(object):
 
         self.bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair,i in self.bpe_codes.items()])
 
-        self.separator = separator
-
-        self.vocab = vocab
-
-        self.glossaries = glossaries if glossaries else []
-
-        self.cache = {}
+    def fingerprint(self):
+        """Hash of everything that determines segmentations; stored with
+        cache snapshots, so that stale snapshots are not used."""
+        h = hashlib.sha1()
+        for pair, i in sorted(self.bpe_codes.items(), key=lambda x: x[1]):
+            h.update(' '.join(pair).encode('utf-8') + b'\n')
+        h.update(repr((self.version, self.separator, self.glossaries)).encode('utf-8'))
+        if self.vocab:
+            h.update('\n'.join(sorted(self.vocab)).encode('utf-8'))
+        return h.hexdigest()
+
+    def load_cache(self, path):
+        """Warm the cache from a snapshot written by save_cache(). Other
+        files (or snapshots for other codes) are read as word lists, e.g.
+        a vocabulary file: the first field of each line is encoded."""
+        with open(path, encoding='utf-8') as f:
+            header = f.readline()
+            if header.rstrip('\n') == '#bpe-cache ' + self.fingerprint():
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 2 or not fields[0] or not fields[1]:
+                        continue # e.g. truncated last line
+                    self.cache.put(fields[0], tuple(fields[1].split(' ')))
+                return
+            f.seek(0)
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] != '#bpe-cache':
+                    self.segment_tokens([fields[0]])
+
+    def save_cache(self, path):
+        """Write the cache (least recently used first) to a file. The file
+        is written under a unique temporary name in the same directory
+        and then renamed, so readers never see a partial snapshot."""
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.write('#bpe-cache {0}\n'.format(self.fingerprint()))
+                for word, segments in self.cache.items():
+                    if '\t' in word or '\n' in word:
+                        continue
+                    f.write('{0}\t{1}\n'.format(word, ' '.join(segments)))
+            os.chmod(tmp, 0o644) # mkstemp creates it private
+            os.rename(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
 
     def process_line(self, line):
         """segment line, dealing with leading and trailing whitespace"""
@@ -100,7 +173,7 @@ class BPE(object):
                                           self.separator,
                                           self.version,
                                           self.cache,
-                                          self.glossaries)]
+                                          self.glossary_matcher)]
 
             for item in new_word[:-1]:
                 output.append(item + self.separator)
@@ -109,6 +182,44 @@ class BPE(object):
         return output
 
     def _isolate_glossaries(self, word):
+        return self.glossary_matcher.isolate(word)
+
+class Glossaries(object):
+    """Glossaries compiled once, rather than per word and glossary.
+
+    A combined pattern of all glossaries serves as a pre-filter: most words
+    contain none of them and are returned as they are right away. Another
+    one checks if a word matches any glossary as a whole. Glossaries with
+    backreferences (or that cannot be combined for other reasons) are
+    checked one by one instead.
+    """
+
+    def __init__(self, glossaries):
+        self.glossaries = [(re.compile('^'+g+'$'), re.compile(g)) for g in glossaries]
+        self.any = self.whole = None
+        if glossaries and not any(re.search(r'\\[1-9]|\(\?P=', g) for g in glossaries):
+            try:
+                self.any = re.compile('|'.join('(?:{0})'.format(g) for g in glossaries))
+                self.whole = re.compile('|'.join('(?:^{0}$)'.format(g) for g in glossaries))
+            except re.error:
+                self.any = self.whole = None
+
+    def __iter__(self):
+        return iter(self.glossaries)
+
+    def __len__(self):
+        return len(self.glossaries)
+
+    def match(self, word):
+        """True if word matches one of the glossaries as a whole."""
+        if self.whole is not None:
+            return self.whole.match(word) is not None
+        return any(whole.match(word) for whole, pattern in self.glossaries)
+
+    def isolate(self, word):
+        """Isolate the glossaries in word, one glossary after the other."""
+        if not self.glossaries or (self.any is not None and not self.any.search(word)):
+            return [word]
         word_segments = [word]
         for gloss in self.glossaries:
             word_segments = [out_segments for segment in word_segments
@@ -160,9 +271,66 @@ def create_parser(subparsers=None):
         help="Glossaries. Words matching any of the words/regex provided in glossaries will not be affected "+
              "by the BPE (i.e. they will neither be broken into subwords, nor concatenated with other subwords. "+
              "Can be provided as a list of words/regex after the --glossaries argument. Enclose each regex in quotes.")
+    parser.add_argument(
+        '--num-workers', type=int, default=1,
+        metavar="INT",
+        help="Number of processes (default: %(default)s). The input is split into chunks that are processed in parallel; "+
+             "the output is in the original order. Compiled codes/vocabulary (.bin) are shared between the processes.")
+    parser.add_argument(
+        '--chunk-size', type=int, default=1000,
+        metavar="INT",
+        help="Number of lines per chunk with --num-workers (default: %(default)s)")
 
     return parser
 
+def load_bpe(codes, merges=-1, separator='@@', vocabulary=None, vocabulary_threshold=None, glossaries=None):
+    """Create a BPE object from file names; compiled codes or vocabulary
+    files (.bin, see compile_codes()) are memory-mapped."""
+    if codes.endswith('.bin'):
+        codes = MMapTable(codes)
+    else:
+        codes = codecs.open(codes, encoding='utf-8')
+    if vocabulary and vocabulary.endswith('.bin'):
+        vocabulary = VocabularyTable(MMapTable(vocabulary), vocabulary_threshold)
+    elif vocabulary:
+        vocabulary = read_vocabulary(codecs.open(vocabulary, encoding='utf-8'), vocabulary_threshold)
+    return BPE(codes, merges, separator, vocabulary, glossaries)
+
+# BPE object of a worker process (see process_parallel)
+_worker_bpe = None
+
+def _init_worker(bpe_args):
+    global _worker_bpe
+    _worker_bpe = load_bpe(**bpe_args)
+
+def _process_chunk(lines):
+    return ''.join(_worker_bpe.process_line(line) for line in lines)
+
+def process_parallel(lines, bpe_args, num_workers, chunk_size=1000):
+    """Segment lines (an iterable) in num_workers processes, each with its own
+    BPE object created by load_bpe(**bpe_args). Yields the output of chunks
+    of chunk_size lines in the original order; only a few chunks per worker
+    are in flight at any time, so the input is not read all at once."""
+    pool = multiprocessing.Pool(num_workers, _init_worker, (bpe_args,))
+    try:
+        pending = deque()
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                pending.append(pool.apply_async(_process_chunk, (chunk,)))
+                chunk = []
+                if len(pending) >= 4 * num_workers:
+                    yield pending.popleft().get()
+        if chunk:
+            pending.append(pool.apply_async(_process_chunk, (chunk,)))
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
 def get_pairs(word):
     """Return set of symbol pairs in a word.
 
@@ -179,12 +347,15 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
     """Encode word based on list of BPE merge operations, which are applied consecutively
     """
 
-    if orig in cache:
-        return cache[orig]
+    cached = cache.get(orig)
+    if cached is not None:
+        return cached
 
-    for glossary in glossaries:
-        if re.match('^'+glossary+'$', orig):
-            cache[orig] = (orig,)
+    if glossaries:
+        if not isinstance(glossaries, Glossaries):
+            glossaries = Glossaries(glossaries)
+        if glossaries.match(orig):
+            cache.put(orig, (orig,))
             return (orig,)
 
     if version == (0, 1):
@@ -194,39 +365,10 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
     else:
         raise NotImplementedError
 
-    pairs = get_pairs(word)
-
-    if not pairs:
+    if len(word) < 2:
         return orig
 
-    while True:
-        bigram = min(pairs, key = lambda pair: bpe_codes.get(pair, float('inf')))
-        if bigram not in bpe_codes:
-            break
-        first, second = bigram
-        new_word = []
-        i = 0
-        while i < len(word):
-            try:
-                j = word.index(first, i)
-                new_word.extend(word[i:j])
-                i = j
-            except:
-                new_word.extend(word[i:])
-                break
-
-            if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                new_word.append(first+second)
-                i += 2
-            else:
-                new_word.append(word[i])
-                i += 1
-        new_word = tuple(new_word)
-        word = new_word
-        if len(word) == 1:
-            break
-        else:
-            pairs = get_pairs(word)
+    word = apply_merges(word, bpe_codes)
 
     # don't print end-of-word symbols
     if word[-1] == '</w>':
@@ -237,9 +379,55 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
     if vocab:
         word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
 
-    cache[orig] = word
+    cache.put(orig, word)
     return word
 
+def apply_merges(word, bpe_codes):
+    """Apply BPE merge operations to a tuple of symbols.
+
+    Same result as repeatedly merging all (non-overlapping, left-to-right)
+    occurrences of the adjacent pair with the lowest rank, but the symbols
+    are kept in a linked list and the candidate pairs in a heap, so the word
+    is not rescanned after each merge. Heap entries are (rank, position of
+    the left symbol); entries that became stale are skipped when popped.
+    """
+    symbols = list(word)
+    end = len(symbols)
+    nxt = list(range(1, end + 1))
+    prv = list(range(-1, end - 1))
+    heap = []
+    for i in range(end - 1):
+        rank = bpe_codes.get((symbols[i], symbols[i+1]))
+        if rank is not None:
+            heap.append((rank, i))
+    heapq.heapify(heap)
+
+    while heap:
+        # all occurrences of the best pair, in left-to-right order
+        rank = heap[0][0]
+        positions = []
+        while heap and heap[0][0] == rank:
+            positions.append(heapq.heappop(heap)[1])
+        for i in positions:
+            j = nxt[i]
+            if symbols[i] is None or j == end or \
+               bpe_codes.get((symbols[i], symbols[j])) != rank:
+                continue # stale, or overlapping with the previous merge
+            symbols[i] += symbols[j]
+            symbols[j] = None
+            nxt[i] = nxt[j]
+            if nxt[i] != end:
+                prv[nxt[i]] = i
+                r = bpe_codes.get((symbols[i], symbols[nxt[i]]))
+                if r is not None:
+                    heapq.heappush(heap, (r, i))
+            if prv[i] >= 0:
+                r = bpe_codes.get((symbols[prv[i]], symbols[i]))
+                if r is not None:
+                    heapq.heappush(heap, (r, prv[i]))
+
+    return tuple(s for s in symbols if s is not None)
+
 def recursive_split(segment, bpe_codes, vocab, separator, final=False):
     """Recursively split segment into smaller units (by reversing BPE merges)
     until all units are either in-vocabulary, or cannot be split futher."""
@@ -292,6 +480,106 @@ def check_vocab_and_split(orig, bpe_codes, vocab, separator):
     return out
 
 
+# Compiled codes and vocabularies: memory-mapped tables (see mmap_table.py)
+# that load instantly and are shared between processes. Keys of codes
+# tables: 'c' + pair (separated by a space) -> rank, and 'r' + merged
+# symbol -> pair, plus the codes file version and the number of merges.
+# Vocabulary tables map words to frequencies; the threshold is applied on
+# lookup.
+
+def compile_codes(codes, path, merges=-1):
+    """Compile BPE codes (an open codes file) into a table at path."""
+    bpe = BPE(codes, merges)
+    table = {'\0version': '.'.join(str(x) for x in bpe.version),
+             '\0merges': str(merges)}
+    for pair, i in bpe.bpe_codes.items():
+        table['c' + ' '.join(pair)] = str(i)
+    for merged, pair in bpe.bpe_codes_reverse.items():
+        table['r' + merged] = ' '.join(pair)
+    build(table, path)
+
+def compile_vocabulary(vocab_file, path):
+    """Compile a vocabulary file produced by get_vocab.py into a table at path."""
+    table = {}
+    for line in vocab_file:
+        word, freq = line.strip('\r\n ').split(' ')
+        table[word] = str(max(int(freq), int(table.get(word, freq))))
+    build(table, path)
+
+class CodesTable(object):
+    """Compiled codes, looked up like BPE.bpe_codes: pair -> rank.
+
+    Lookups of recently seen pairs are memoized in a small dict (cleared
+    when it reaches memo_size entries), as encode() asks for the same
+    pairs over and over.
+    """
+
+    def __init__(self, table, memo_size=50000):
+        self.table = table
+        self.memo = {}
+        self.memo_size = memo_size
+
+    def get(self, pair, default=None):
+        try:
+            rank = self.memo[pair]
+        except KeyError:
+            rank = self.table.get('c' + pair[0] + ' ' + pair[1])
+            if rank is not None:
+                rank = int(rank)
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+            self.memo[pair] = rank
+        return default if rank is None else rank
+
+    def __contains__(self, pair):
+        return self.get(pair) is not None
+
+    def __getitem__(self, pair):
+        rank = self.get(pair)
+        if rank is None:
+            raise KeyError(pair)
+        return rank
+
+    def items(self):
+        for key, rank in self.table.items():
+            if key[0] == 'c':
+                yield tuple(key[1:].split(' ')), int(rank)
+
+class ReverseCodesTable(object):
+    """Compiled codes, looked up like BPE.bpe_codes_reverse: merged -> pair."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, merged):
+        pair = self.table.get('r' + merged)
+        if pair is None:
+            raise KeyError(merged)
+        return tuple(pair.split(' '))
+
+class VocabularyTable(object):
+    """Compiled vocabulary with frequency threshold; works like the set
+    returned by read_vocabulary()."""
+
+    def __init__(self, table, threshold=None):
+        self.table = table
+        self.threshold = threshold
+        self.empty = None
+
+    def __contains__(self, word):
+        freq = self.table.get(word)
+        return freq is not None and (self.threshold == None or int(freq) >= self.threshold)
+
+    def __iter__(self):
+        for word, freq in self.table.items():
+            if self.threshold == None or int(freq) >= self.threshold:
+                yield word
+
+    def __bool__(self):
+        if self.empty is None:
+            self.empty = next(iter(self), None) is None
+        return not self.empty
+
 def read_vocabulary(vocab_file, threshold):
     """read vocabulary file produced by get_vocab.py, and filter according to frequency threshold.
     """
@@ -315,12 +603,18 @@ def isolate_glossary(word, glossary):
     For example, if 'USA' is the glossary and '1934USABUSA' the word, the return value is:
         ['1934', 'USA', 'B', 'USA']
     """
+    # glossary may also be a pair of compiled patterns (see Glossaries)
+    if isinstance(glossary, tuple):
+        whole, glossary = glossary
+    else:
+        whole, glossary = re.compile('^'+glossary+'$'), re.compile(glossary)
     # regex equivalent of (if word == glossary or glossary not in word)
-    if re.match('^'+glossary+'$', word) or not re.search(glossary, word):
+    if whole.match(word) or not glossary.search(word):
         return [word]
     else:
-        splits = re.split(glossary, word)
-        segments = [segment.strip('\r\n ') for (n_split, split) in enumerate(splits[:-1]) for segment in [split, re.findall(glossary, word)[n_split]] if segment != '']
+        splits = glossary.split(word)
+        found = glossary.findall(word)
+        segments = [segment.strip('\r\n ') for (n_split, split) in enumerate(splits[:-1]) for segment in [split, found[n_split]] if segment != '']
         return segments + [splits[-1].strip('\r\n ')] if splits[-1] != '' else segments
 
 if __name__ == '__main__':
@@ -348,20 +642,19 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # read/write files as UTF-8
-    args.codes = codecs.open(args.codes.name, encoding='utf-8')
     if args.input.name != '<stdin>':
         args.input = codecs.open(args.input.name, encoding='utf-8')
     if args.output.name != '<stdout>':
         args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
-    if args.vocabulary:
-        args.vocabulary = codecs.open(args.vocabulary.name, encoding='utf-8')
 
-    if args.vocabulary:
-        vocabulary = read_vocabulary(args.vocabulary, args.vocabulary_threshold)
-    else:
-        vocabulary = None
+    bpe_args = dict(codes=args.codes.name, merges=args.merges, separator=args.separator,
+                    vocabulary=args.vocabulary.name if args.vocabulary else None,
+                    vocabulary_threshold=args.vocabulary_threshold, glossaries=args.glossaries)
 
-    bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries)
-
-    for line in args.input:
-        args.output.write(bpe.process_line(line))
+    if args.num_workers > 1:
+        for output in process_parallel(args.input, bpe_args, args.num_workers, args.chunk_size):
+            args.output.write(output)
+    else:
+        bpe = load_bpe(**bpe_args)
+        for line in args.input:
+            args.output.write(bpe.process_line(line))
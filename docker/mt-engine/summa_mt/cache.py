@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+A simple thread-safe LRU cache with optional size bound and time-to-live,
+which keeps track of hits and misses.
+"""
+
+import time, threading
+from collections import OrderedDict
+
+class LRUCache:
+    def __init__(self, maxsize=0, ttl=0):
+        """
+        maxsize: max. number of entries (0: unbounded)
+        ttl: seconds after which an entry expires (0: never)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict() # key -> (value, time stored)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+                del self.data[key]
+                entry = None
+                pass
+            if entry is None:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time() if self.ttl else 0)
+            self.data.move_to_end(key)
+            if self.maxsize:
+                while len(self.data) > self.maxsize:
+                    self.data.popitem(last=False)
+                    pass
+                pass
+        return
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def items(self):
+        """Snapshot of (key, value) pairs, least recently used first."""
+        with self.lock:
+            return [(k,v[0]) for k,v in self.data.items()]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self.data), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits/lookups if lookups else 0.)
+    pass # end of class definition
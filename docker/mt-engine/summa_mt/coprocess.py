@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Long-lived external processes (co-processes) that are fed line-delimited
+input over a pipe.
+
+Starting a Perl script for every paragraph means paying fork+exec and
+Perl's module compilation over and over again. A CoProcess is started
+once and kept around. Each request is written to the process's stdin,
+followed by a sentinel line; the output is read back until the sentinel
+reappears. This requires that the external command
+- flushes its output after each line (e.g., the Moses scripts with -b), and
+- passes the sentinel through unchanged (all-caps ASCII letters survive
+  tokenization, detokenization and (de)truecasing).
+If the process dies, it is restarted automatically. If it doesn't answer
+within /timeout/ seconds, it is killed and restarted, and the request
+fails with a TimeoutError.
+"""
+
+import os, time, select, signal, logging, threading
+from subprocess import Popen, PIPE
+
+logger = logging.getLogger(__name__)
+
+SENTINEL = "SUMMAMTENDOFINPUT"
+TIMEOUT = 60 # seconds
+
+class CoProcess:
+    def __init__(self, cmd, sentinel=SENTINEL, max_restarts=3, timeout=TIMEOUT):
+        self.cmd = cmd
+        self.sentinel = sentinel
+        self.max_restarts = max_restarts
+        self.timeout = timeout
+        self.proc = None
+        self.lock = threading.Lock()
+        return
+
+    def start(self):
+        logger.info("Starting co-process: %s"%(' '.join(self.cmd)))
+        # in a process group of its own, so that kill() also gets any
+        # children (e.g. of a shell wrapper) that hold on to the pipes
+        self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE,
+                          start_new_session=True)
+        return
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+        return
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+                self.proc.wait(timeout=5)
+            except Exception:
+                self.proc.kill()
+                pass
+            pass
+        self.proc = None
+        return
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _feed(self, data):
+        # Runs in a separate thread, so that large inputs can't deadlock
+        # on a full stdout pipe while we're still writing.
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass # detected by the reader as EOF
+        return
+
+    def _communicate(self, text):
+        data = text if text.endswith('\n') else text + '\n'
+        data = (data + self.sentinel + '\n').encode('utf8')
+        writer = threading.Thread(target=self._feed, args=(data,))
+        writer.daemon = True
+        writer.start()
+        # We read from the file descriptor directly (rather than with
+        # readline()), so that we can give up when the deadline passes.
+        fd = self.proc.stdout.fileno()
+        deadline = time.time() + self.timeout if self.timeout else None
+        lines, partial = [], b''
+        while True:
+            if deadline is not None:
+                ready = select.select([fd], [], [], max(0, deadline - time.time()))[0]
+                if not ready: # e.g. the process doesn't flush its output
+                    raise TimeoutError("Co-process %s didn't answer within "
+                                       "%s sec."%(self.cmd[0], self.timeout))
+                pass
+            chunk = os.read(fd, 65536)
+            if not chunk: # EOF: the process died on us
+                writer.join()
+                raise EOFError("Co-process %s terminated."%self.cmd[0])
+            *complete, partial = (partial + chunk).split(b'\n')
+            for line in complete:
+                line = line.decode('utf8')
+                if line.strip().upper() == self.sentinel:
+                    writer.join()
+                    return ''.join(lines)
+                lines.append(line + '\n')
+                pass
+            pass
+        return
+
+    def __call__(self, text):
+        with self.lock:
+            for attempt in range(self.max_restarts + 1):
+                if not self.alive():
+                    self.start()
+                try:
+                    return self._communicate(text)
+                except TimeoutError:
+                    logger.error("Co-process %s timed out. Restarting it."
+                                 %self.cmd[0])
+                    self.kill() # the writer may still be blocked on stdin
+                    self.start()
+                    raise
+                except EOFError:
+                    logger.warning("Co-process %s died (exit code %r). "
+                                   "Restarting it."
+                                   %(self.cmd[0], self.proc.poll()))
+                    self.stop()
+                    pass
+                pass
+            raise Exception("Co-process %s keeps failing. Giving up."
+                            %self.cmd[0])
+    pass # end of class definition
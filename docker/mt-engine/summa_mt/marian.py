@@ -4,8 +4,12 @@
 # - check if marian is already running
 # - allow connection to remote marian server
 
-import regex, time, sys, os, logging, yaml, multiprocessing
-from prepostprocess import PrePostProcessor
+import regex, time, sys, os, logging, yaml, multiprocessing, threading, hashlib
+from collections import deque, defaultdict, OrderedDict
+from prepostprocess import PrePostProcessor, build_models
+from truecase import model_base
+from cache import LRUCache
+from translation_memory import TranslationMemory
 from websocket import create_connection
 from argparse import ArgumentParser
 from subprocess import Popen, PIPE
@@ -13,6 +17,10 @@ from subprocess import Popen, PIPE
 logger = logging.getLogger(__name__)
 basedir  = os.path.dirname(__file__)
 
+# mini-batch size with --sort-by-length if none is given (sorting a single
+# batch would save no padding)
+SORTED_MINI_BATCH_SENTENCES = 32
+
 
 def safe_add_arg(ap, longname, shortname=None, **kwargs):
     try:
@@ -43,6 +51,71 @@ def setup_argparser(ap):
     safe_add_arg(ap, "--beam-size", type=int,
                  help="Beam size for translation.",
                  default=os.environ.get('MARIAN_BEAM_SIZE',0))
+
+    # pipelined communication with marian-server
+    safe_add_arg(ap, "--mini-batch-sentences", type=int,
+                 help="Max. number of sentences per request to marian-server "
+                 "(0: send everything in a single request).",
+                 default=os.environ.get('MT_MINI_BATCH_SENTENCES',0))
+    safe_add_arg(ap, "--mini-batch-tokens", type=int,
+                 help="Max. number of (BPE) tokens per request to "
+                 "marian-server (0: no limit).",
+                 default=os.environ.get('MT_MINI_BATCH_TOKENS',0))
+    safe_add_arg(ap, "--max-in-flight", type=int,
+                 help="Max. number of mini-batches sent to marian-server "
+                 "before we wait for the first translation to come back.",
+                 default=os.environ.get('MT_MAX_IN_FLIGHT',2))
+    safe_add_arg(ap, "--connections", type=int,
+                 help="Number of connections to each marian-server.",
+                 default=os.environ.get('MT_CONNECTIONS',1))
+    safe_add_arg(ap, "--pipeline-depth", type=int,
+                 help="Run preprocessing, decoding and postprocessing of "
+                 "consecutive inputs concurrently, with up to this many "
+                 "inputs waiting in front of each stage (0: sequentially).",
+                 default=os.environ.get('MT_PIPELINE_DEPTH',0))
+    safe_add_arg(ap, "--sort-by-length", action='store_true',
+                 help="Group sentences of similar length into the same "
+                 "mini-batch (the original order is restored afterwards). "
+                 "Without --mini-batch-sentences or --mini-batch-tokens, "
+                 "mini-batches have %d sentences."%SORTED_MINI_BATCH_SENTENCES,
+                 default=bool(os.environ.get('MT_SORT_BY_LENGTH','')))
+    safe_add_arg(ap, "--sort-window", type=int,
+                 help="With --sort-by-length, number of consecutive sentences "
+                 "sorted together (0: all sentences of a request).",
+                 default=os.environ.get('MT_SORT_WINDOW',0))
+
+    # several marian servers
+    safe_add_arg(ap, "--marian-servers", type=int,
+                 help="Number of marian-server processes to run. CPU threads "
+                 "are divided evenly among them.",
+                 default=os.environ.get('MARIAN_SERVERS',1))
+    safe_add_arg(ap, "--pin-cpus", action='store_true',
+                 help="Pin each marian-server process to its own "
+                 "subset of the available cores.",
+                 default=bool(os.environ.get('MARIAN_PIN_CPUS','')))
+    safe_add_arg(ap, "--health-check-interval", type=float,
+                 help="Seconds between health checks of marian servers "
+                 "and connections.",
+                 default=os.environ.get('MT_HEALTH_CHECK_INTERVAL',30))
+
+    # translation cache
+    safe_add_arg(ap, "--cache-size", type=int,
+                 help="Max. number of sentence translations to cache "
+                 "(0: no caching, -1: unbounded).",
+                 default=os.environ.get('MT_CACHE_SIZE',0))
+    safe_add_arg(ap, "--cache-ttl", type=float,
+                 help="Seconds after which cached translations expire "
+                 "(0: never).",
+                 default=os.environ.get('MT_CACHE_TTL',0))
+    safe_add_arg(ap, "--translation-memory",
+                 help="Path to an sqlite database with translations of "
+                 "preprocessed sentences, shared by all workers on a node "
+                 "(created if necessary).",
+                 default=os.environ.get('MT_TRANSLATION_MEMORY',None))
+    safe_add_arg(ap, "--build-processes", type=int,
+                 help="Number of processes for building missing model files "
+                 "(truecasing lexicons) at startup (0: one per CPU).",
+                 default=os.environ.get('MT_BUILD_PROCESSES',0))
     return
 
 # find the marian executable
@@ -58,18 +131,44 @@ if not marian:
     raise Exception("Cannot find marian server executable.")
 
 class MarianServer:
-    def __init__(self,config):
+    def __init__(self,config,port=None):
         self.config = config
+        self.port = port
         self.marian = None
+        self.start_args = None
         return
     
-    def start(self,loglevel='critical',cpu_threads=multiprocessing.cpu_count(), beam=0):
+    def start(self,loglevel='critical',cpu_threads=multiprocessing.cpu_count(),
+              beam=0, cpus=None):
         # marian = os.environ.get('MARIAN_SERVER_EXE',
+        self.start_args = (loglevel, cpu_threads, beam, cpus)
         cmd = [ marian, "-c", self.config, "--log-level", loglevel,
                 "--cpu-threads", "%d"%cpu_threads ]
         if beam: cmd.extend(["--beam-size","%d"%beam])
+        if self.port: cmd.extend(["--port","%d"%self.port])
         logger.info("Invoking marian server as: %s"%(' '.join(cmd)))
         self.marian = Popen(cmd)
+        if cpus:
+            # Not with preexec_fn, which can deadlock the child when other
+            # threads are running. marian starts its worker threads (which
+            # inherit the affinity) only after loading the model.
+            logger.info("Pinning marian server to cpus %s"
+                        %(",".join("%d"%c for c in cpus)))
+            try:
+                os.sched_setaffinity(self.marian.pid, cpus)
+            except OSError as e:
+                logger.warning("Could not pin marian server: %s"%e)
+                pass
+            pass
+        return
+
+    def running(self):
+        return self.marian is not None and self.marian.poll() is None
+
+    def restart(self):
+        logger.warning("Restarting marian server (port %r)."%self.port)
+        self.stop()
+        self.start(*self.start_args)
         return
 
     def stop(self):
@@ -95,6 +194,8 @@ class MarianClient:
             self.url = "%s%s%s%s"%(self.prot, self.host, self.port, self.path)
         else:
             self.url = "ws://localhost:8080/translate"
+        self.conn = None
+        self.server = None # the MarianServer behind this connection, if ours
         return
 
     def connect(self):
@@ -127,6 +228,41 @@ class MarianClient:
             pass
         pass
                     
+    def probe(self, timeout=30):
+        """
+        Check that the server answers by translating a one-token sentence;
+        a websocket ping succeeds as long as the connection is up, even if
+        marian-server is stuck. Reconnect once if there is no answer.
+        """
+        try:
+            self.roundtrip(timeout)
+        except Exception:
+            try:
+                self.conn.close() # a late answer must not be read later
+            except Exception:
+                pass
+            self.conn = self.connect()
+            self.roundtrip(timeout)
+            pass
+        return
+
+    def roundtrip(self, timeout):
+        old_timeout = self.conn.gettimeout()
+        self.conn.settimeout(timeout)
+        try:
+            self.conn.send(".")
+            self.conn.recv()
+        finally:
+            self.conn.settimeout(old_timeout)
+        return
+
+    def send(self,text):
+        self.conn.send(text)
+        return
+
+    def recv(self):
+        return self.conn.recv()
+
     def translate(self,line):
         retries = 3
         while retries:
@@ -144,6 +280,292 @@ class MarianClient:
             pass
         return translation
     pass # end of class definition of MarianClient
+
+class MarianPool:
+    """
+    A pool of connections to one or more marian servers. Work goes to the
+    healthy connection with the fewest outstanding requests. Every
+    /check_interval/ seconds, a background thread restarts servers we
+    started ourselves if they died, and probes idle connections (and
+    re-establishes them if needed).
+
+    A connection with outstanding requests belongs to the thread that sent
+    them until all answers are back (marian-server answers in order, so two
+    threads must not share a connection); other threads wait for a free
+    connection.
+    """
+    def __init__(self, clients, check_interval=30):
+        self.clients = clients
+        self.check_interval = check_interval
+        self.load = dict((c,0) for c in clients)
+        self.owner = {} # client -> thread that has requests outstanding on it
+        self.unhealthy = set()
+        self.lock = threading.Condition()
+        if check_interval:
+            t = threading.Thread(target=self.monitor, name="marian-health")
+            t.daemon = True
+            t.start()
+        return
+
+    def monitor(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error("Health check failed: %s"%e)
+                pass
+            pass
+        return
+
+    def reconnect(self):
+        for client in self.clients:
+            client.reconnect()
+        return
+
+    def check_health(self):
+        """
+        Check the idle connections one at a time. Restarting a server and
+        reconnecting can take long, so the pool lock is not held meanwhile;
+        the connection being checked is reserved as if it were busy, and
+        the others remain usable.
+        """
+        me = threading.get_ident()
+        for client in self.clients:
+            with self.lock:
+                if self.load[client]:
+                    continue # in use by another thread
+                self.load[client] += 1
+                self.owner[client] = me
+                pass
+            healthy = True
+            try:
+                if client.server and not client.server.running():
+                    client.server.restart()
+                    client.reconnect()
+                else:
+                    client.probe()
+            except Exception:
+                logger.warning("Connection to %s is unhealthy."%client.url)
+                healthy = False
+                pass
+            with self.lock:
+                if healthy:
+                    self.unhealthy.discard(client)
+                else:
+                    self.unhealthy.add(client)
+                pass
+            self.done(client)
+            pass
+        return
+
+    def pick(self):
+        """Get the least loaded healthy client that isn't used by another
+        thread, waiting for one to become free if necessary."""
+        me = threading.get_ident()
+        with self.lock:
+            while True:
+                candidates = [c for c in self.clients if c not in self.unhealthy]
+                if not candidates: candidates = self.clients
+                candidates = [c for c in candidates
+                              if self.owner.get(c, me) == me]
+                if candidates: break
+                self.lock.wait()
+                pass
+            client = min(candidates, key=lambda c: self.load[c])
+            self.load[client] += 1
+            self.owner[client] = me
+            return client
+
+    def done(self, client):
+        with self.lock:
+            self.load[client] -= 1
+            if not self.load[client]:
+                del self.owner[client]
+                self.lock.notify_all()
+        return
+
+    def failed(self, client):
+        with self.lock:
+            self.unhealthy.add(client)
+        return
+
+    def stats(self):
+        return dict((c.url,self.load[c]) for c in self.clients)
+    pass # end of class definition of MarianPool
+
+def sentence_length(s):
+    return len(s.split())
+
+def make_batches(sentences, max_sentences=0, max_tokens=0,
+                 length=sentence_length):
+    """
+    Group an iterable of sentences into mini-batches of at most
+    /max_sentences/ sentences and /max_tokens/ tokens (0: no limit).
+    A single sentence exceeding the token limit makes a batch of its own.
+    """
+    batch, tokens = [], 0
+    for s in sentences:
+        n = length(s)
+        if len(batch) and ((max_sentences and len(batch) >= max_sentences)
+                           or (max_tokens and tokens + n > max_tokens)):
+            yield batch
+            batch, tokens = [], 0
+            pass
+        batch.append(s)
+        tokens += n
+        pass
+    if len(batch):
+        yield batch
+    return
+
+def bucket_by_length(sentences, window=0):
+    """
+    Generate (position, sentence) pairs, sorted by sentence length within
+    windows of /window/ consecutive sentences (0: a single window), so that
+    mini-batches contain sentences of similar length and marian wastes less
+    time on padding.
+    """
+    def flush(buf):
+        buf.sort(key=lambda x: sentence_length(x[1]))
+        return buf
+    buf = []
+    for x in enumerate(sentences):
+        buf.append(x)
+        if window and len(buf) == window:
+            yield from flush(buf)
+            buf = []
+            pass
+        pass
+    yield from flush(buf)
+    return
+
+class BatchPipeline:
+    """
+    Sends mini-batches of sentences to marian-server without waiting for
+    each translation to come back: up to /max_in_flight/ batches are
+    outstanding at any time, spread over the connections of a MarianPool
+    (least loaded first). Since marian-server answers the requests on a
+    connection in order, we always wait for the oldest outstanding batch,
+    so results are reassembled in the original order. Sentences may be given as a
+    generator; they are consumed lazily, so preprocessing of the next
+    chunk overlaps with decoding of the previous ones.
+    """
+    def __init__(self, pool, max_in_flight=2, max_sentences=0, max_tokens=0,
+                 sort_by_length=False, sort_window=0):
+        self.pool = pool
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_sentences = max_sentences
+        self.max_tokens = max_tokens
+        self.sort_by_length = sort_by_length
+        self.sort_window = sort_window
+        return
+
+    def _send(self, client, inflight, batch):
+        inflight[client].append(batch)
+        try:
+            client.send("\n".join(batch))
+        except Exception:
+            self._recover(client, inflight)
+        return
+
+    def _recover(self, client, inflight, retries=3):
+        """Reconnect and resend everything still in flight on /client/."""
+        for attempt in range(retries):
+            logger.warning("Lost connection to %s. Reconnecting."%client.url)
+            try:
+                client.reconnect()
+                for batch in inflight[client]:
+                    client.send("\n".join(batch))
+                return
+            except Exception:
+                if attempt + 1 == retries:
+                    logger.error("Cannot communicate with server. Giving up.")
+                    self.pool.failed(client)
+                    raise
+                pass
+            pass
+        return
+
+    def _receive(self, client, inflight):
+        batch = inflight[client][0]
+        for attempt in range(3):
+            try:
+                translation = client.recv()
+                break
+            except Exception:
+                if attempt == 2: raise
+                self._recover(client, inflight)
+                pass
+            pass
+        inflight[client].popleft()
+        self.pool.done(client)
+        lines = translation.split('\n')
+        if len(lines) > len(batch) and not any(lines[len(batch):]):
+            lines = lines[:len(batch)]
+        if len(lines) != len(batch):
+            # The translations can't be matched up with the sentences;
+            # the caller's request fails (and the remaining connections
+            # are abandoned) rather than return misaligned output.
+            raise Exception("Sent %d sentences to marian-server but got %d back."
+                            %(len(batch), len(lines)))
+        return lines
+
+    def abandon(self, inflight):
+        """Give back connections whose answers we no longer wait for after
+        an error. Late answers would go to the next user of a connection,
+        so it is closed; the pool re-establishes it."""
+        for client, batches in inflight.items():
+            if not len(batches):
+                continue
+            logger.warning("Dropping connection to %s with %d batches in "
+                           "flight."%(client.url, len(batches)))
+            try:
+                client.conn.close()
+            except Exception:
+                pass
+            self.pool.failed(client)
+            for b in batches:
+                self.pool.done(client)
+            batches.clear()
+            pass
+        return
+
+    def __call__(self, sentences):
+        if self.sort_by_length:
+            sentences = bucket_by_length(sentences, self.sort_window)
+        else:
+            sentences = enumerate(sentences)
+        result = {}
+        pending = deque() # (client, positions) in the order batches were sent
+        inflight = defaultdict(deque)
+        try:
+            self._run(sentences, result, pending, inflight)
+        except BaseException:
+            self.abandon(inflight)
+            raise
+        return [result[k] for k in range(len(result))]
+
+    def _run(self, sentences, result, pending, inflight):
+        def receive():
+            client, positions = pending.popleft()
+            lines = self._receive(client, inflight)
+            for i, k in enumerate(positions):
+                result[k] = lines[i]
+            return
+        batches = make_batches(sentences, self.max_sentences, self.max_tokens,
+                               length=lambda x: sentence_length(x[1]))
+        for batch in batches:
+            if len(pending) >= self.max_in_flight:
+                receive()
+            client = self.pool.pick()
+            self._send(client, inflight, [x[1] for x in batch])
+            pending.append((client, [x[0] for x in batch]))
+            pass
+        while len(pending):
+            receive()
+        return
+    pass # end of class definition of BatchPipeline
                     
 class Translator:
     def __init__(self, options, marian = None):
@@ -152,6 +574,12 @@ class Translator:
                                    multiprocessing.cpu_count())
         self.beam_size = getattr(options,'beam_size',
                                  os.environ.get('MARIAN_BEAM_SIZE',0))
+        self.mini_batch_sentences = getattr(options,'mini_batch_sentences',0)
+        self.mini_batch_tokens = getattr(options,'mini_batch_tokens',0)
+        self.max_in_flight = getattr(options,'max_in_flight',2)
+        connections = getattr(options,'connections',1)
+        num_servers = max(1, getattr(options,'marian_servers',1))
+        self.pin_cpus = getattr(options,'pin_cpus',False)
         # marian should None for the time being
         # eventually it should be an optional specification of
         # host, port, and protocol of a connection to a marian service
@@ -159,51 +587,336 @@ class Translator:
         self.model_info = yaml.load(open(model_dir+"/model_info.yml"))
         self.srclang = self.model_info['source-language']
         self.trglang = self.model_info['target-language']
+        self.model_id = self.model_identity(model_dir, self.beam_size)
+
+        # cache of translations of preprocessed sentences
+        cache_size = int(getattr(options,'cache_size',0))
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(max(0,cache_size),
+                                  float(getattr(options,'cache_ttl',0)))
+        tm = getattr(options,'translation_memory',None)
+        self.memory = TranslationMemory(tm, self.model_id) if tm else None
+        self.decoded_sentences = 0 # for estimating time saved by the cache
+        self.decoding_time = 0.
 
-        self.preprocess  = PrePostProcessor(model_dir+"/preprocess.yml")
-        self.postprocess = PrePostProcessor(model_dir+"/postprocess.yml")
+        # Building missing model files can take minutes, so we do it (and
+        # set up pre- and postprocessing) in the background while marian is
+        # starting up; translation requests wait until we are ready.
+        self.preprocess  = None
+        self.postprocess = None
+        self.ready = threading.Event()
+        self.startup_error = None
+        t = threading.Thread(target=self.load_processors, name="model-setup",
+                             args=(model_dir, getattr(options,'build_processes',0)))
+        t.daemon = True
+        t.start()
+
+        self.marian_clients = []
         if not marian:
             info = yaml.load(open(model_dir+"/decoder.yml"))
-            marian = "ws://localhost:%d/translate"%info.get('port',8080)
-            # print("MARIAN",marian)
-            self.marian_server = MarianServer(model_dir+"/decoder.yml")
+            port = info.get('port',8080)
+            self.marian_servers = [MarianServer(model_dir+"/decoder.yml",
+                                                port + i if num_servers > 1 else None)
+                                   for i in range(num_servers)]
+            for i, server in enumerate(self.marian_servers):
+                url = "ws://localhost:%d/translate"%(port + i)
+                for k in range(max(1,connections)):
+                    client = MarianClient(url)
+                    client.server = server
+                    self.marian_clients.append(client)
+                    pass
+                pass
         else:
-            self.marian_server = None
+            # marian may be a comma-separated list of servers
+            self.marian_servers = []
+            self.marian_clients = [MarianClient(url) for url in marian.split(',')
+                                   for k in range(max(1,connections))]
+            pass
+        self.marian_server = self.marian_servers[0] if self.marian_servers else None
+        self.marian_client = self.marian_clients[0]
+        self.marian_pool = MarianPool(self.marian_clients,
+                                      getattr(options,'health_check_interval',30))
+        self.pipeline = None
+        sort_by_length = getattr(options,'sort_by_length',False)
+        if sort_by_length and not (self.mini_batch_sentences or
+                                   self.mini_batch_tokens):
+            self.mini_batch_sentences = SORTED_MINI_BATCH_SENTENCES
+        if self.mini_batch_sentences or self.mini_batch_tokens:
+            self.pipeline = BatchPipeline(self.marian_pool,
+                                          self.max_in_flight,
+                                          self.mini_batch_sentences,
+                                          self.mini_batch_tokens,
+                                          sort_by_length,
+                                          getattr(options,'sort_window',0))
             pass
-        self.marian_client = MarianClient(marian)
         self.start()
         return
                     
     def start(self):
-        if self.marian_server:
-            self.marian_server.start(cpu_threads=self.cpu_threads,
-                                     beam=self.beam_size)
+        n = len(self.marian_servers)
+        cpus = sorted(os.sched_getaffinity(0)) if self.pin_cpus else []
+        for i, server in enumerate(self.marian_servers):
+            server.start(cpu_threads=max(1, int(self.cpu_threads) // n),
+                         beam=self.beam_size,
+                         cpus=cpus[i*len(cpus)//n:(i+1)*len(cpus)//n] or None)
             pass
-        self.marian_client.reconnect()
+        self.marian_pool.reconnect()
         return
 
+    def load_processors(self, model_dir, processes=0):
+        """Build missing model files and set up pre- and postprocessing."""
+        try:
+            for f in ["preprocess.yml", "postprocess.yml"]:
+                build_models(model_dir+"/"+f, int(processes))
+                pass
+            self.preprocess  = PrePostProcessor(model_dir+"/preprocess.yml")
+            self.postprocess = PrePostProcessor(model_dir+"/postprocess.yml")
+        except Exception as e:
+            logger.exception("Could not set up pre- and postprocessing.")
+            self.startup_error = e
+        finally:
+            self.ready.set()
+        return
+
+    def wait_ready(self, timeout=None):
+        """Wait until pre- and postprocessing are set up. Returns False if
+        that didn't happen within /timeout/ seconds; raises the error if
+        setting them up failed."""
+        if not self.ready.wait(timeout):
+            return False
+        if self.startup_error is not None:
+            raise self.startup_error
+        return True
+
     def stop(self):
-        if self.marian_server:
-            self.marian_server.stop()
+        for server in self.marian_servers:
+            server.stop()
+            pass
+        for p in [self.preprocess, self.postprocess]:
+            if p is not None: p.close()
             pass
+        if self.memory is not None:
+            self.memory.close()
         return
     
+    @staticmethod
+    def model_files(model_dir):
+        """The files that translations depend on besides the configuration:
+        marian's models and vocabularies, and the model files of the pre-
+        and postprocessing steps (truecasing model, BPE codes etc.). Files
+        built at startup are represented by their sources (the text model
+        of a truecasing lexicon), so that the identity doesn't depend on
+        whether, when, or where the lexicon was built."""
+        def path(f):
+            return f if os.path.isabs(f) else "%s/%s"%(model_dir,f)
+        files = []
+        if os.path.exists(model_dir+"/decoder.yml"):
+            decoder = yaml.load(open(model_dir+"/decoder.yml")) or {}
+            for key in ['models', 'vocabs']:
+                files.extend(path(f) for f in decoder.get(key) or [])
+                pass
+            pass
+        for cfg in ["preprocess.yml", "postprocess.yml"]:
+            if not os.path.exists("%s/%s"%(model_dir,cfg)):
+                continue
+            config = yaml.load(open("%s/%s"%(model_dir,cfg))) or {}
+            for step in config.get('steps') or []:
+                for key in ['model', 'codes', 'vocabulary']:
+                    if not step.get(key):
+                        continue
+                    f = path(step[key])
+                    if step.get('action') == 'truecase' and \
+                       os.path.exists(model_base(f)):
+                        f = model_base(f)
+                    files.append(f)
+                    pass
+                pass
+            pass
+        return files
+
+    @staticmethod
+    def model_identity(model_dir, beam_size=0):
+        """
+        A fingerprint of the model, used in cache and translation memory
+        keys: the configuration files, and the size and modification time of
+        the model files, so that a retrained model deployed with the same
+        configuration gets a new identity.
+        """
+        h = hashlib.sha1()
+        for f in ["model_info.yml", "decoder.yml",
+                  "preprocess.yml", "postprocess.yml"]:
+            if os.path.exists("%s/%s"%(model_dir,f)):
+                h.update(open("%s/%s"%(model_dir,f),'rb').read())
+            pass
+        for f in Translator.model_files(model_dir):
+            if os.path.exists(f):
+                st = os.stat(f)
+                h.update(("%s %d %d\n"%(os.path.basename(f), st.st_size,
+                                         st.st_mtime_ns)).encode('utf8'))
+            pass
+        h.update(("beam=%s"%beam_size).encode('utf8'))
+        return h.hexdigest()
+
+    def marian_translate(self,sentences):
+        """Send preprocessed sentences to marian, without consulting the cache."""
+        if self.pipeline:
+            return self.pipeline(sentences)
+        sentences = list(sentences)
+        if not len(sentences):
+            return []
+        client = self.marian_pool.pick()
+        try:
+            translation = client.translate("\n".join(sentences))
+        finally:
+            self.marian_pool.done(client)
+        return translation.strip().split('\n')
+
+    def decode(self,sentences):
+        """
+        Translate preprocessed sentences. Cached translations are looked up
+        first (in the cache, then in the translation memory); only the
+        remaining sentences are sent to marian, and the cached translations
+        are spliced back in.
+        """
+        start = time.time()
+        if self.cache is None and self.memory is None:
+            if self.pipeline is None:
+                sentences = list(sentences)
+                translation = self.marian_translate(sentences)
+                self.check_length(sentences, translation)
+            else:
+                # Don't read a generator ahead: the pipeline consumes it
+                # lazily (and checks each batch), so we count as it goes.
+                count = 0
+                def counted():
+                    nonlocal count
+                    for s in sentences:
+                        count += 1
+                        yield s
+                    return
+                translation = self.marian_translate(counted())
+                self.check_length(range(count), translation)
+            self.decoded_sentences += len(translation)
+            self.decoding_time += time.time() - start
+            return translation
+
+        translation = []
+        misses = OrderedDict() # sentence -> positions in translation
+        def unknown():
+            for s in sentences:
+                t = self.lookup(s)
+                translation.append(t)
+                if t is None:
+                    if s not in misses: # translate repeated sentences once
+                        misses[s] = []
+                        yield s
+                    misses[s].append(len(translation) - 1)
+                    pass
+                pass
+            return
+        new = self.marian_translate(unknown())
+        # Never cache or memorize translations that may be misaligned.
+        self.check_length(misses, new)
+        for (s, positions), t in zip(misses.items(), new):
+            if self.cache is not None:
+                self.cache.put((self.model_id, s), t)
+            for i in positions:
+                translation[i] = t
+            pass
+        if self.memory is not None:
+            self.memory.put_many((s, translation[p[0]]) for s,p in misses.items())
+        self.decoded_sentences += len(misses)
+        self.decoding_time += time.time() - start
+        return translation
+
+    @staticmethod
+    def check_length(sentences, translation):
+        if len(translation) != len(sentences):
+            raise Exception("Marian returned %d translations for %d sentences."
+                            %(len(translation), len(sentences)))
+        return
+
+    def lookup(self,sentence):
+        """Look up a known translation of a preprocessed sentence."""
+        key = (self.model_id, sentence)
+        t = self.cache.get(key) if self.cache is not None else None
+        if t is None and self.memory is not None:
+            t = self.memory.get(sentence)
+            if t is not None and self.cache is not None:
+                self.cache.put(key, t)
+            pass
+        return t
+
+    def cache_stats(self):
+        """Hit rate of the cache and estimated decoding time saved by it
+        (and by the translation memory)."""
+        if self.cache is None and self.memory is None:
+            return None
+        stats = self.cache.stats() if self.cache is not None \
+                else dict(hits=0, misses=0)
+        if self.memory is not None:
+            stats['memory_hits'] = self.memory.hits
+            stats['memory_misses'] = self.memory.misses
+        per_sentence = self.decoding_time/self.decoded_sentences \
+                       if self.decoded_sentences else 0.
+        stats['saved_decoding_time'] = per_sentence * \
+            (stats['hits'] + stats.get('memory_hits',0))
+        return stats
+
+    def preprocess_text(self,text):
+        """Preprocess a string or a list of strings into a list of sentences."""
+        self.wait_ready()
+        chunks = [text] if type(text).__name__ == 'str' else text
+        return [s for chunk in chunks for s in self.preprocess(chunk)]
+
+    def postprocess_text(self,sentences):
+        self.wait_ready()
+        return self.postprocess(sentences)
+
+    def translate_in_parts(self,text,part_size):
+        """
+        Translate a list of strings in parts of at least /part_size/
+        (preprocessed) sentences, generating the postprocessed translation
+        of each part as soon as it comes back from marian. A string is never
+        split across parts.
+        """
+        self.wait_ready()
+        part = []
+        for chunk in text:
+            part.extend(self.preprocess(chunk))
+            if len(part) >= part_size:
+                yield self.postprocess(self.decode(part))
+                part = []
+                pass
+            pass
+        if len(part):
+            yield self.postprocess(self.decode(part))
+        return
+
     def __call__(self,text):
+        self.wait_ready()
         start = time.time()
-        if type(text).__name__ == 'str':
-            sentences = self.preprocess(text)
-        elif type(text).__name__ == 'list':
-            sentences = [s for chunk in text for s in self.preprocess(chunk)]
+        if self.pipeline:
+            # a generator, so that preprocessing overlaps with decoding
+            chunks = [text] if type(text).__name__ == 'str' else text
+            sentences = (s for chunk in chunks for s in self.preprocess(chunk))
+        else:
+            sentences = self.preprocess_text(text)
+            logger.info("Preprocessing took %.2f sec. (%d sentences)"\
+                        %(time.time() - start, len(sentences)))
             pass
-        logger.info("Preprocessing took %.2f sec. (%d sentences)"\
-                    %(time.time() - start, len(sentences)))
 
         tstart = time.time()
-        translation = self.marian_client.translate("\n".join(sentences))
-        logger.info("Marian took %.2f sec. to translate."%(time.time() - tstart))
+        translation = self.decode(sentences)
+        logger.info("Marian took %.2f sec. to translate (%d sentences)."\
+                    %(time.time() - tstart, len(translation)))
+        if self.cache is not None or self.memory is not None:
+            logger.info("Cache: %(hits)d hits, %(misses)d misses, "
+                        "%(saved_decoding_time).2f sec. saved"%self.cache_stats())
 
         pstart = time.time()
-        postprocessed = self.postprocess(translation.strip().split('\n'))
+        postprocessed = self.postprocess(translation)
         logger.info("Postprocessing took %.2f sec.."%(time.time() - pstart))
         logger.info("Total translation time: %.2f"%(time.time() - start))
         return postprocessed
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Read-only string -> string tables in a file that is memory-mapped, so that
+all worker processes on a node share one copy in the page cache and
+lookups don't need any system calls.
+
+File layout (all integers little-endian):
+  header:  magic (8 bytes), number of slots, number of entries (uint64 each)
+  slots:   uint64 per slot; 0 for an empty slot, otherwise 1 + the offset
+           of the entry in the data section
+  data:    entries: key length, value length (uint32 each), key, value
+           (UTF-8)
+The slots form an open-addressing hash table (linear probing on the CRC32
+of the key) that is at most half full.
+"""
+
+import sys, os, mmap, struct, zlib
+from array import array
+
+MAGIC = b'SUMMAMT1'
+HEADER = struct.Struct('<8sQQ')
+ENTRY = struct.Struct('<II')
+_unpack_entry = ENTRY.unpack_from
+
+def build(table, path):
+    """Write dict /table/ to /path/ (atomically, via a temporary file)."""
+    nslots = 8
+    while nslots < 2 * len(table):
+        nslots *= 2
+        pass
+    slots = array('Q', bytes(8 * nslots))
+    data = bytearray()
+    for key, value in table.items():
+        k, v = key.encode('utf8'), value.encode('utf8')
+        i = zlib.crc32(k) % nslots
+        while slots[i]:
+            i = (i + 1) % nslots
+            pass
+        slots[i] = len(data) + 1
+        data += ENTRY.pack(len(k), len(v)) + k + v
+        pass
+    if sys.byteorder != 'little':
+        slots.byteswap()
+    tmp = "%s.%d.tmp"%(path, os.getpid())
+    with open(tmp, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, nslots, len(table)))
+        slots.tofile(out)
+        out.write(data)
+        pass
+    os.rename(tmp, path)
+    return
+
+class MMapTable:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            pass
+        magic, self.nslots, self.size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a lexicon file."%path)
+        if sys.byteorder != 'little':
+            raise Exception("Lexicon files can only be read on "
+                            "little-endian machines.")
+        start = HEADER.size
+        self.slots = memoryview(self.mm)[start:start + 8 * self.nslots].cast('Q')
+        self.data = start + 8 * self.nslots
+        return
+
+    def _find(self, k):
+        """Offset of the value for key /k/ (bytes) and its length, or None."""
+        mm, slots, nslots = self.mm, self.slots, self.nslots
+        base = self.data + ENTRY.size - 1
+        n = len(k)
+        i = zlib.crc32(k) % nslots
+        while slots[i]:
+            p = base + slots[i]
+            klen, vlen = _unpack_entry(mm, p - ENTRY.size)
+            if klen == n and mm[p:p+n] == k:
+                return p + n, vlen
+            i = (i + 1) % nslots
+            pass
+        return None
+
+    def get(self, key, default=None):
+        found = self._find(key.encode('utf8'))
+        if found is None:
+            return default
+        p, vlen = found
+        return self.mm[p:p+vlen].decode('utf8')
+
+    def __contains__(self, key):
+        return self._find(key.encode('utf8')) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        p = self.data
+        while p < len(self.mm):
+            klen, vlen = ENTRY.unpack_from(self.mm, p)
+            p += ENTRY.size
+            yield (self.mm[p:p+klen].decode('utf8'),
+                   self.mm[p+klen:p+klen+vlen].decode('utf8'))
+            p += klen + vlen
+            pass
+        return
+
+    def close(self):
+        self.slots.release()
+        self.mm.close()
+        return
+    pass # end of class definition
@@ -9,12 +9,108 @@ import sys, regex as re, unicodedata
 # for Unicode, as they leave much punctuation ambiguous (e.g., quotation marks).
 # - UG
 
+# The rules are applied one after the other, each to the output of the
+# previous one. Running some 80 substitutions over every line is slow, so
+# by default they are compiled into fewer passes (see compile_rules):
+# - runs of consecutive rules that replace a single character (a literal or
+#   a simple character class, without context) become one str.translate
+#   table; the table is built by pushing each character through the rules
+#   of the run, so it does exactly what the rules do in turn;
+# - rules grouped in a sub-list can't interact with each other (their
+#   matches don't overlap and none of them matches another one's output)
+#   and are applied in a single pass over their alternation. Sub-lists must
+#   not contain lookarounds, as the winning alternative is re-matched on its
+#   own to compute the replacement.
+# Normalizer.reference() applies the rules one by one, as before; use
+# --verify on the command line to check that both agree.
+
+_SPECIAL = set(r'.^$*+?{}[]|()\\')
+
+def _single_chars(pattern):
+    """The characters matched by /pattern/ if it matches exactly one
+    character without context, None otherwise."""
+    if len(pattern) == 1 and pattern not in _SPECIAL:
+        return pattern
+    if pattern == r'\r':
+        return '\r'
+    m = re.fullmatch(r'\[([^\\\[\]^-]+)\]', pattern)
+    return m.group(1) if m else None
+
+def _flatten(rules):
+    for rule in rules:
+        if isinstance(rule, list):
+            yield from rule
+        else:
+            yield rule
+        pass
+    return
+
+def _translation_table(run):
+    """str.translate table equivalent to applying the single-character
+    rules in /run/ in turn."""
+    table = {}
+    for c in set("".join(chars for chars,pattern,repl in run)):
+        s = c
+        for chars,pattern,repl in run:
+            s = pattern.sub(repl,s)
+            pass
+        table[ord(c)] = s
+        pass
+    return table
+
+def _dispatch(members):
+    def replace(m):
+        pattern, repl = members[int(m.lastgroup[1:])]
+        m = pattern.fullmatch(m.group())
+        return repl(m) if callable(repl) else m.expand(repl)
+    return replace
+
+def compile_rules(rules):
+    """
+    Compile a list of (pattern, replacement) rules and sub-lists of
+    independent rules into a list of passes (pattern, replacement).
+    If the replacement is a dict, it is a str.translate table, and the
+    pattern matches the characters it translates (str.translate is slow
+    on non-ASCII strings, so we only call it when there's anything to do).
+    """
+    passes = []
+    run = []
+    def end_run():
+        if run:
+            table = _translation_table(run)
+            chars = "".join(sorted(chr(c) for c in table))
+            passes.append((re.compile("[%s]"%re.escape(chars)), table))
+            del run[:]
+            pass
+        return
+    for rule in rules:
+        if isinstance(rule, list):
+            end_run()
+            members = [(re.compile(x),y) for x,y in rule]
+            alternation = "|".join("(?P<_%d>%s)"%(i,x) for i,(x,y) in enumerate(rule))
+            passes.append((re.compile(alternation), _dispatch(members)))
+            continue
+        pattern, replacement = re.compile(rule[0]), rule[1]
+        chars = _single_chars(rule[0])
+        if chars is not None and isinstance(replacement, str):
+            try: # replacements referring to groups are not for us
+                [pattern.sub(replacement, c) for c in chars]
+                run.append((chars, pattern, replacement))
+                continue
+            except re.error:
+                pass
+            pass
+        end_run()
+        passes.append((pattern, replacement))
+        pass
+    end_run()
+    return passes
+
 class Normalizer:
-    def __init__(self,language,penn=False):
+    def __init__(self,language,penn=False,fused=True):
         rules = [(r'\r',''),
                  
                  (r'，', r','),
-                 (r'。 *', r'. '),
                  (r'、', r','),
                  (r'”', r'"'),
                  (r'“', r'"'),
@@ -39,7 +135,6 @@ class Normalizer:
                  (r'７', r'7'),
                  (r'８', r'8'),
                  (r'４', r'4'),
-                 (r'． *', r'. '),
                  (r'～', r'\~'),
                  (r'’', r'\''),
                  (r'…', r'\.\.\.'),
@@ -50,6 +145,11 @@ class Normalizer:
                  (r'】', r'\]'),
                  (r'％', r'\%'),
 
+                 # full stops; applied after the single-character rules
+                 # above (which they don't interact with), so that those
+                 # can all be folded into one translation table
+                 (r'[。．] *', r'. '),
+
                  # Combining several rules from the Moses perl script
                  # here to deal with whitespacing around parentheses.
                  # This is actually something that should be dealt
@@ -79,8 +179,8 @@ class Normalizer:
              # The following will cause problems with nested quotations!
              # Also, see remarks on quotations and punctuation below. [UG]
              (r'[‘‚’]', '"'), 
-             (r"''", '"'),
-             (r'´´', '"'),
+             [(r"''", '"'),
+              (r'´´', '"')],
 
              # Disagree with the rule below, should be the other way around - UG
              (r'…', '...'), 
@@ -96,12 +196,12 @@ class Normalizer:
              # handle non-breaking spaces (\xA0)
              (r'[\xA0]\%', '\%'),
              (r'nº[\xA0]', 'nº '), 
-             (r'[\xA0]:', ':'),
-             (r'[\xA0]ºC', ' ºC'),
-             (r'[\xA0]cm', ' cm'),
-             (r'[\xA0]\?', '\?'),
-             (r'[\xA0]\!', '\!'),
-             (r'[\xA0];', ';'),
+             [(r'[\xA0]:', ':'),
+              (r'[\xA0]ºC', ' ºC'),
+              (r'[\xA0]cm', ' cm'),
+              (r'[\xA0]\?', '\?'),
+              (r'[\xA0]\!', '\!'),
+              (r'[\xA0];', ';')],
              (r',[\xA0]', ', '),
             ]
         )
@@ -136,10 +236,23 @@ class Normalizer:
             pass
         
         rules.append((r'\s+', ' ')) # single space between tokens
-        self.rules = [(re.compile(x),y) for x,y in rules]
+        self.rules = [(re.compile(x),y) for x,y in _flatten(rules)]
+        self.passes = compile_rules(rules) if fused else self.rules
         return
 
     def __call__(self,line):
+        line = unicodedata.normalize('NFKC',line)
+        for pattern,replacement in self.passes:
+            if isinstance(replacement, dict):
+                if pattern.search(line):
+                    line = line.translate(replacement)
+            else:
+                line = pattern.sub(replacement,line)
+            pass
+        return line.strip()
+
+    def reference(self,line):
+        """Apply the rules one by one (for verification)."""
         line = unicodedata.normalize('NFKC',line)
         for pattern,replacement in self.rules:
             line = pattern.sub(replacement,line)
@@ -159,12 +272,23 @@ if __name__ == "__main__":
                        help="Penn Treebank mode")
         p.add_argument("-l",dest='lang', default="en",
                        help="ISO 639-1 two-letter language code")
+        p.add_argument("--verify",action='store_true',
+                       help="Also apply the rules one by one and report "
+                       "lines where the result differs (on stderr)")
         return p.parse_args()
 
     opts = interpret_args()
     normpunct = Normalizer(opts.lang,opts.penn)
-    for line in sys.stdin:
-        print(normpunct(line),flush=opts.flush)
+    for i,line in enumerate(sys.stdin):
+        result = normpunct(line)
+        if opts.verify:
+            expected = normpunct.reference(line)
+            if result != expected:
+                print("MISMATCH in line %d:\n  fused:     %s\n  reference: %s"
+                      %(i+1,result,expected),file=sys.stderr)
+                pass
+            pass
+        print(result,flush=opts.flush)
         pass
     
 
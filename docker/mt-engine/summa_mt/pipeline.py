@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Staged translation pipeline: preprocessing, decoding and postprocessing
+run in separate threads connected by bounded queues, so that item N+1 is
+being preprocessed while item N is being decoded and item N-1 is being
+postprocessed. The heavy lifting in each stage happens outside the Python
+interpreter (Perl co-processes, marian-server), so threads suffice.
+"""
+
+import threading, queue, logging
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class StagedPipeline:
+    def __init__(self, stages, queue_size=4):
+        """
+        stages: list of (name, function) pairs; each function maps the
+        output of the previous stage to the input of the next one.
+        queue_size: max. number of items waiting in front of each stage.
+        """
+        self.names = [name for name,func in stages]
+        self.queues = [queue.Queue(maxsize=max(1,queue_size)) for s in stages]
+        self.threads = []
+        for i, (name, func) in enumerate(stages):
+            t = threading.Thread(target=self._run, args=(i, func),
+                                 name="pipeline-%s"%name)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+            pass
+        return
+
+    def _run(self, i, func):
+        inq = self.queues[i]
+        outq = self.queues[i+1] if i + 1 < len(self.queues) else None
+        while True:
+            job = inq.get()
+            if job is _STOP:
+                if outq: outq.put(_STOP)
+                return
+            future, item = job
+            try:
+                result = func(item)
+            except Exception as e:
+                logger.exception("Pipeline stage '%s' failed."%self.names[i])
+                future.set_exception(e)
+                continue
+            if outq:
+                outq.put((future, result))
+            else:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Pipeline queue depths: %s"%", ".join\
+                                 ("%s %d"%(n,d) for n,d in self.depths().items()))
+                future.set_result(result)
+                pass
+            pass
+        return
+
+    def depths(self):
+        """Number of items waiting in front of each stage."""
+        return dict((n,q.qsize()) for n,q in zip(self.names, self.queues))
+
+    def submit(self, item):
+        """Queue an item; blocks while the first queue is full.
+        Returns a concurrent.futures.Future for the result."""
+        future = Future()
+        self.queues[0].put((future, item))
+        return future
+
+    def map(self, items, skip=None, window=0):
+        """
+        Push /items/ through the pipeline, yielding (item, result) pairs in
+        the original order. Items for which skip(item) is true bypass the
+        pipeline with result None. At most /window/ items are in the
+        pipeline at any time (default: enough to keep all stages busy).
+        """
+        window = window or 2 * sum(q.maxsize for q in self.queues)
+        pending = deque()
+        for item in items:
+            if skip and skip(item):
+                future = Future()
+                future.set_result(None)
+            else:
+                future = self.submit(item)
+            pending.append((item, future))
+            while len(pending) > window:
+                item, future = pending.popleft()
+                yield item, future.result()
+                pass
+            pass
+        while len(pending):
+            item, future = pending.popleft()
+            yield item, future.result()
+            pass
+        return
+
+    def close(self):
+        self.queues[0].put(_STOP)
+        for t in self.threads:
+            t.join()
+        return
+    pass # end of class definition
+
+def translation_stages(translator):
+    """Pipeline stages for translating text with a marian.Translator."""
+    return [("preprocess", translator.preprocess_text),
+            ("decode", translator.decode),
+            ("postprocess", translator.postprocess_text)]
@@ -1,48 +1,156 @@
 #!/usr/bin/env python3
 
 import sys, os, select, regex, split_sentences, logging
-import unicodedata, yaml, codecs
+import unicodedata, yaml, codecs, time, threading
 import apply_bpe
 
 from subprocess import Popen, PIPE
 
 from split_sentences import SentenceSplitter, force_split_long_sentences
 from normalize_punctuation import Normalizer
-from truecase import Truecaser
+from truecase import Truecaser, needs_build, build_lexicon
+from coprocess import CoProcess
+from mmap_table import MMapTable
 
 logger  = logging.getLogger(__name__)
 basedir = os.path.realpath(os.path.dirname(__file__))
 
 class external_call:
-    def __init__(self,cmd):
+    def __init__(self,cmd,persistent=False,flush_option=None,timeout=None):
         if not cmd.startswith('/'):
             cmd = "%s/%s"%(basedir, cmd)
         self.cmd = cmd.split()
+        self.coprocess = None
+        if persistent:
+            # the co-process must flush its output after each line; tools
+            # that need an option for that declare it in their config
+            if flush_option and flush_option not in self.cmd:
+                self.cmd.append(flush_option)
+            if timeout is None:
+                self.coprocess = CoProcess(self.cmd)
+            else:
+                self.coprocess = CoProcess(self.cmd, timeout=float(timeout))
+            pass
         return
     def __call__(self,line):
+        if self.coprocess:
+            return self.coprocess(line)
         pipe = Popen(self.cmd,stdin=PIPE,stdout=PIPE)
         out,err = pipe.communicate(input=line.encode('utf8'))
         return out.decode('utf8')
+    def process_batch(self,lines):
+        # one call for all lines
+        return self("\n".join(lines).strip()+"\n").strip().split('\n')
+    def close(self):
+        if self.coprocess:
+            self.coprocess.stop()
+        return
 
 class BPE_Wrapper:
     def __init__(self,model_root,config):
         assert 'codes' in config
         path = "%s/%%s"%model_root
-        codes = codecs.open(path%config['codes'], encoding='utf8')
+        merges = int(config.get('merges','-1').replace('K','000'))
+        # use compiled codes and vocabulary (see package.py) if available
+        codes = path%config['codes']
+        if os.path.exists(codes+".bin"):
+            codes = MMapTable(codes+".bin")
+            if codes['\0merges'] != str(merges):
+                logger.warning("%s was compiled for a different number "
+                               "of merges, using %s instead."
+                               %(codes.path, path%config['codes']))
+                codes = codecs.open(path%config['codes'], encoding='utf8')
+                pass
+        else:
+            codes = codecs.open(codes, encoding='utf8')
         if 'vocabulary' in config:
-            vfile = codecs.open(path%config['vocabulary'], encoding='utf8')
             vthresh = int(config['vocabulary-threshold'])
-            vocab = apply_bpe.read_vocabulary(vfile,vthresh)
+            vfile = path%config['vocabulary']
+            if os.path.exists(vfile+".bin"):
+                vocab = apply_bpe.VocabularyTable(MMapTable(vfile+".bin"),vthresh)
+            else:
+                vfile = codecs.open(vfile, encoding='utf8')
+                vocab = apply_bpe.read_vocabulary(vfile,vthresh)
         else: vocab = None
         sep = config.get('separator','@@')
         gloss = config.get('glossaries',None)
-        merges = int(config.get('merges','-1').replace('K','000'))
-        self.bpe = apply_bpe.BPE(codes, merges, sep, vocab, gloss)
+        self.bpe = apply_bpe.BPE(codes, merges, sep, vocab, gloss,
+                                 int(config.get('cache-size',0)))
+
+        # The cache can be warmed up from a word list (e.g. the vocabulary)
+        # or from a snapshot of the cache that we write from time to time.
+        self.snapshot = config.get('cache-snapshot')
+        self.snapshot_interval = float(config.get('cache-snapshot-interval',600))
+        if self.snapshot:
+            self.snapshot = os.path.join(model_root, self.snapshot)
+        self.last_snapshot = time.time()
+        self.snapshot_lock = threading.Lock()
+        warmup = config.get('cache-warmup')
+        if self.snapshot and os.path.exists(self.snapshot):
+            warmup = self.snapshot
+        elif warmup:
+            warmup = os.path.join(model_root, warmup)
+        if warmup:
+            start = time.time()
+            self.bpe.load_cache(warmup)
+            logger.info("Loaded %d BPE segmentations from %s in %.2f sec."
+                        %(len(self.bpe.cache), warmup, time.time() - start))
         return
     def __call__(self,line):
-        return self.bpe.process_line(line)
+        ret = self.bpe.process_line(line)
+        self.snapshot_if_due()
+        return ret
+    def process_batch(self,lines):
+        process_line = self.bpe.process_line
+        ret = [process_line(line) for line in lines]
+        self.snapshot_if_due()
+        return ret
+    def snapshot_if_due(self):
+        # Don't make translations wait while another thread is writing.
+        if not self.snapshot or not self.snapshot_lock.acquire(blocking=False):
+            return
+        try:
+            if time.time() - self.last_snapshot > self.snapshot_interval:
+                self._save_snapshot()
+        finally:
+            self.snapshot_lock.release()
+        return
+    def save_snapshot(self):
+        with self.snapshot_lock:
+            self._save_snapshot()
+        return
+    def _save_snapshot(self):
+        self.last_snapshot = time.time()
+        try:
+            self.bpe.save_cache(self.snapshot)
+        except Exception as e:
+            logger.warning("Could not write BPE cache snapshot: %s"%e)
+            return
+        logger.info("BPE cache: %(size)d entries, %(hits)d hits, "
+                    "%(misses)d misses"%self.bpe.cache.stats())
+        return
+    def close(self):
+        if self.snapshot:
+            self.save_snapshot()
+        return
     pass # end of class definition
 
+class UnicodeNormalizer:
+    def __init__(self,form):
+        self.form = form
+        return
+
+    def __call__(self,line):
+        return unicodedata.normalize(self.form, line)
+
+    def process_batch(self,lines):
+        # Line breaks are normalization-invariant and block composition,
+        # so we can normalize all lines in one go.
+        out = unicodedata.normalize(self.form, "\n".join(lines)).split("\n")
+        if len(out) != len(lines): # some line contained a line break
+            out = [unicodedata.normalize(self.form, line) for line in lines]
+        return out
+
 
 class PunctFix:
     def __init__(self):
@@ -67,6 +175,10 @@ class PunctFix:
     def __call__(self,line):
         return self.pattern.sub(self.fix, line)
 
+    def process_batch(self,lines):
+        sub, fix = self.pattern.sub, self.fix
+        return [sub(fix, line) for line in lines]
+
 class RegexRule:
     def __init__(self,pattern,replacement):
         self.replacement = replacement
@@ -75,6 +187,27 @@ class RegexRule:
 
     def __call__(self,line):
         return self.pattern.sub(self.replacement,line)
+
+    def process_batch(self,lines):
+        sub, replacement = self.pattern.sub, self.replacement
+        return [sub(replacement, line) for line in lines]
+
+class DeBPE(RegexRule):
+    default_pattern = r'@@(?: +|$)'
+
+    def __init__(self,pattern=default_pattern):
+        super().__init__(pattern,'')
+        # The default pattern never matches across lines, so we can
+        # apply it to all lines at once, with $ matching at each line end.
+        self.multiline = None
+        if pattern == self.default_pattern:
+            self.multiline = regex.compile(pattern, regex.M)
+        return
+
+    def process_batch(self,lines):
+        if self.multiline is None:
+            return super().process_batch(lines)
+        return self.multiline.sub('', "\n".join(lines)).split("\n")
     
 class Step:
     def __init__(self, model_path, config):
@@ -83,25 +216,29 @@ class Step:
         
         if 'command' in config:
             self.external = True
-            self.action = external_call(config['command'])
+            self.action = external_call(config['command'],
+                                        config.get('persistent',False),
+                                        config.get('flush-option'),
+                                        config.get('timeout'))
 
         elif 'normalize_unicode' == self.name:
-            form = config.get('form','NFC')
-            self.action = lambda x: unicodedata.normalize(form, x)
+            self.action = UnicodeNormalizer(config.get('form','NFC'))
 
         elif 'truecase' == self.name:
             self.action = Truecaser("%s/%s"%(model_path,config['model']))
 
         elif 'split_sentences' == self.name:
             maxlen = config['max-sentence-length']
-            self.action = SentenceSplitter(config['language'],maxlen)
+            self.action = SentenceSplitter(config['language'],maxlen,
+                                           config.get('persistent',False),
+                                           config.get('sessions',1),
+                                           config.get('engine','eserix'))
 
         elif 'bpe' == self.name:
             self.action = BPE_Wrapper(model_path, config)
 
         elif 'de-bpe' == self.name:
-            pattern = config.get('pattern',r'@@(?: +|$)')
-            self.action = lambda x: regex.sub(pattern,'', x)
+            self.action = DeBPE(config.get('pattern',DeBPE.default_pattern))
 
         elif 'fix-eos' == self.name:
             self.action = PunctFix()
@@ -114,20 +251,41 @@ class Step:
 
         else:
             raise "Unknown preprocessing step"
+
+        # Actions may process a list of lines in one go (process_batch);
+        # otherwise we call them line by line.
+        self.process_batch = getattr(self.action, 'process_batch', None)
+        if self.process_batch is None:
+            action = self.action
+            self.process_batch = lambda lines: [action(line) for line in lines]
         return
 
     def __call__(self, input):
-        if type(input).__name__ == "list":
-            if self.external:
-                result = self.action("\n".join(input).strip()+"\n").strip()
-                return [line.strip() for line in result.split('\n')]
-            else:
-                return [self.action(line).strip() for line in input]
+        if isinstance(input, list):
+            return [line.strip() for line in self.process_batch(input)]
         result = self.action(input)
-        if type(result).__name__ == "str":
+        if isinstance(result, str):
             return result.strip()
         return [line.strip() for line in result]
+
+    def close(self):
+        if hasattr(self.action,'close'):
+            self.action.close()
+        return
     
+def build_models(config, processes=0):
+    """Build the model files that are still missing for the steps in
+    config file /config/ (truecasing lexicons)."""
+    root = os.path.dirname(config)
+    for step in yaml.load(open(config))['steps']:
+        if step['action'] == 'truecase' and 'command' not in step:
+            model = "%s/%s"%(root,step['model'])
+            if needs_build(model):
+                build_lexicon(model, processes)
+            pass
+        pass
+    return
+
 class PrePostProcessor:
     def __init__(self, config, root = None):
         self.root = root if root else os.path.dirname(config)
@@ -137,20 +295,25 @@ class PrePostProcessor:
         return
     
     def __call__(self,text):
-        if __name__ == "__main__":
-            logger.debug("INPUT\n%s\n"%text)
+        if not logger.isEnabledFor(logging.DEBUG):
+            for step in self.steps:
+                text = step(text)
+            return text
+        logger.debug("INPUT\n%s\n"%text)
         for step in self.steps:
             text = step(text)
-            if True or __name__ == "__main__":
-                logger.debug(step.name)
-                if type(text).__name__ == "list":
-                    for t in text:
-                        logger.debug(t)
-                        pass
-                else: logger.debug(text)
-                logger.debug("")
-                pass
+            logger.debug(step.name)
+            if isinstance(text, list):
+                logger.debug("\n".join(text))
+            else: logger.debug(text)
+            logger.debug("")
+            pass
         return text 
+
+    def close(self):
+        for step in self.steps:
+            step.close()
+        return
     pass # end of class definition
 
 if __name__ == "__main__":
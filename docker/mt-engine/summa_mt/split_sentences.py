@@ -3,11 +3,14 @@
 Sentence splitting module. Wraps around ESERIX for some languages,
 ?uses custom hacks for others.
 
-TO DO: Eserix rules are actually just regular expressions. Consider implementing the sentence splitting directly in python
+Eserix rules are actually just regular expressions. The 'srx' engine
+(see srx.py) applies them directly in python, without the Eserix binary.
 """
 
-import sys, os, logging, regex
+import sys, os, logging, regex, shutil, queue, threading
 from subprocess import Popen, PIPE
+from coprocess import CoProcess, TIMEOUT
+from srx import SRXSplitter
 
 global ESERIX_CMD, ESERIX_RULES
 
@@ -38,7 +41,8 @@ for guess in [os.environ.get('ESERIX_CMD', '%s/bin/eserix'%basedir)]:
         break
     pass
 if not ESERIX_CMD:
-    raise Exception("Cannot find Eserix executable.")
+    # not fatal: the 'srx' engine doesn't need the executable
+    logger.warning("Cannot find Eserix executable.")
 
 # languages that Eserix can deal with
 eserix_languages = ["ar", "de", "en", "es", "fr", "hr", "pl", "ru", "zh"]
@@ -51,6 +55,8 @@ supported_languages = eserix_languages + ["fa"]
 
 class Eserix:
     def __init__(self,lang,cmd=ESERIX_CMD,rules=ESERIX_RULES):
+        if not cmd:
+            raise Exception("Cannot find Eserix executable.")
         self.lang = lang
         self.cmd = [cmd, "-l", lang, "-r", rules, '-t']
         return
@@ -61,6 +67,142 @@ class Eserix:
         return out.decode('utf8').strip().split('\n')
     pass
 
+class EserixSession:
+    """
+    A single long-running Eserix process: the rules are parsed once, and
+    paragraphs are sent over a pipe, one per line, each followed by an
+    explicit paragraph delimiter. Eserix doesn't flush its output, so this
+    requires stdbuf (coreutils) to line-buffer it.
+    """
+    delimiter = "SUMMAMTENDOFPARAGRAPH"
+
+    def __init__(self,lang,cmd=ESERIX_CMD,rules=ESERIX_RULES,timeout=TIMEOUT):
+        if not cmd:
+            raise Exception("Cannot find Eserix executable.")
+        stdbuf = shutil.which('stdbuf')
+        if not stdbuf:
+            # without it, we would wait forever for buffered output
+            raise Exception("Persistent Eserix sessions require stdbuf.")
+        self.lang = lang
+        cmd = [stdbuf, '-oL', cmd, "-l", lang, "-r", rules, '-t']
+        self.eserix = CoProcess(cmd, timeout=timeout)
+        return
+
+    def split(self,paragraphs):
+        """Split a list of paragraphs; returns a list of lists of sentences.
+        If Eserix loses or mangles a paragraph delimiter, the paragraphs
+        are split again one at a time."""
+        ret = self._split(paragraphs)
+        if ret is None and len(paragraphs) > 1:
+            logger.warning("Eserix lost paragraph delimiters; splitting "
+                           "%d paragraphs one at a time."%len(paragraphs))
+            ret = [self._split([p]) for p in paragraphs]
+            ret = None if None in ret else [r[0] for r in ret]
+        if ret is None:
+            raise Exception("Eserix lost a paragraph delimiter.")
+        return ret
+
+    def _split(self,paragraphs):
+        """The sentences of each paragraph, or None if the number of
+        delimiters in Eserix's output is wrong."""
+        text = "".join("%s\n%s\n"%(regex.sub(r'\s+',' ',p).strip(),
+                                      self.delimiter)
+                       for p in paragraphs)
+        ret = [[]]
+        for s in self.eserix(text).split('\n'):
+            s = s.strip()
+            if s.upper() == self.delimiter:
+                ret.append([])
+            elif len(s):
+                ret[-1].append(s)
+                pass
+            pass
+        if len(ret) != len(paragraphs) + 1 or ret[-1]:
+            return None
+        return ret[:-1]
+
+    def __call__(self,line):
+        return self.split([line])[0]
+
+    def close(self):
+        self.eserix.stop()
+        return
+    pass
+
+class EserixPool:
+    """
+    A pool of persistent Eserix sessions for one language, so that
+    several documents can be split concurrently. Sessions are started
+    on demand, up to /size/ of them.
+    """
+    def __init__(self,lang,size=1,cmd=ESERIX_CMD,rules=ESERIX_RULES):
+        self.lang = lang
+        self.size = size
+        self.cmd = cmd
+        self.rules = rules
+        self.users = 0 # see get_eserix_pool() and release_eserix_pool()
+        self.idle = queue.Queue()
+        self.sessions = []
+        self.lock = threading.Lock()
+        return
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.sessions) < self.size:
+                session = EserixSession(self.lang,self.cmd,self.rules)
+                self.sessions.append(session)
+                return session
+            pass
+        return self.idle.get()
+
+    def release(self,session):
+        self.idle.put(session)
+        return
+
+    def split(self,paragraphs):
+        session = self.acquire()
+        try:
+            return session.split(paragraphs)
+        finally:
+            self.release(session)
+
+    def __call__(self,line):
+        return self.split([line])[0]
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        return
+    pass
+
+# one pool per language, shared by all sentence splitters in this process
+eserix_pools = {}
+eserix_pools_lock = threading.Lock()
+
+def get_eserix_pool(lang,size=1):
+    """Get the shared pool for /lang/; give it back with release_eserix_pool()."""
+    with eserix_pools_lock:
+        pool = eserix_pools.get(lang)
+        if pool is None:
+            pool = eserix_pools[lang] = EserixPool(lang,size)
+        elif pool.size < size:
+            pool.size = size
+            pass
+        pool.users += 1
+        return pool
+
+def release_eserix_pool(pool):
+    """Close the pool once its last user has released it."""
+    with eserix_pools_lock:
+        pool.users -= 1
+        if pool.users:
+            return
+        if eserix_pools.get(pool.lang) is pool:
+            del eserix_pools[pool.lang]
+        pass
+    pool.close()
+    return
+
 class NLTK_SentenceSplitter:
     def __init__(self, lang):
         D = { "pt" : "portuguese" }
@@ -95,8 +237,16 @@ def force_split_long_sentences(sents,maxlen):
 
 class SentenceSplitter:
 
-    def __init__(self,lang,maxlen=0):
-        if lang in eserix_languages: self.ssplit = Eserix(lang)
+    def __init__(self,lang,maxlen=0,persistent=False,sessions=1,
+                 engine='eserix'):
+        if lang in eserix_languages:
+            if persistent and engine != 'srx' and not shutil.which('stdbuf'):
+                logger.warning("stdbuf not found; starting Eserix "
+                               "for each paragraph instead.")
+                persistent = False
+            if engine == 'srx': self.ssplit = SRXSplitter(lang,ESERIX_RULES)
+            elif persistent: self.ssplit = get_eserix_pool(lang,sessions)
+            else: self.ssplit = Eserix(lang)
         elif lang in nltk_languages: self.ssplit = NLTK_SentenceSplitter(lang)
         else: self.ssplit = SimpleSentenceSplitter(lang)
         self.maxlen = maxlen
@@ -107,6 +257,14 @@ class SentenceSplitter:
         if self.maxlen:
             sents = force_split_long_sentences(sents, self.maxlen)
         return  sents
+
+    def close(self):
+        if isinstance(self.ssplit,EserixPool):
+            release_eserix_pool(self.ssplit) # shared with other splitters
+        elif hasattr(self.ssplit,'close'):
+            self.ssplit.close()
+        self.ssplit = None
+        return
             
 if __name__ == "__main__":
     from argparse import ArgumentParser
@@ -130,12 +288,20 @@ if __name__ == "__main__":
 
     p.add_argument("--maxlen", type=int, default=0, help="maximum sentence length")
 
+    p.add_argument("--engine", choices=['eserix','srx'], default='eserix',
+                   help="use the Eserix binary or apply the SRX rules in python")
+
+    p.add_argument("--persistent", action='store_true',
+                   help="keep a single Eserix process running "
+                   "instead of starting one per paragraph")
+
     opts = p.parse_args()
 
     ESERIX_CMD = opts.cmd
     ESERIX_RULES = opts.rules
     
-    ssplit = SentenceSplitter(opts.lang)
+    ssplit = SentenceSplitter(opts.lang,persistent=opts.persistent,
+                              engine=opts.engine)
 
     if opts.one_par_per_line:
         for line in sys.stdin:
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+In-process sentence splitting with SRX rules (the rules that Eserix uses),
+without calling any external binary.
+
+An SRX rule consists of a 'beforebreak' and an 'afterbreak' regular
+expression and says whether there is a break ('yes') or not ('no') at any
+position where the text before the position matches the former and the text
+after it the latter. The first rule that applies at a given position
+decides. We compile each rule into a zero-width pattern (?<=before)(?=after)
+and, per language, all rules into a single alternation in rule order, so
+that the regex engine finds the decisive rule for us. To avoid running the
+full alternation at every character, candidate positions are found first
+with a (usually tiny) alternation of the break rules only.
+"""
+
+import sys, logging, regex, threading
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+def _tag(elem):
+    """Element tag without XML namespace."""
+    return elem.tag.rsplit('}',1)[-1]
+
+def _children(elem, name):
+    return [c for c in elem if _tag(c) == name]
+
+def _scope_flags(pattern):
+    """Turn leading global inline flags (e.g. '(?i)') into a scoped group,
+    so that they don't leak into other rules once combined."""
+    m = regex.match(r'\(\?([a-zA-Z]+)\)', pattern)
+    if m:
+        return "(?%s:%s)"%(m.group(1), pattern[m.end():])
+    return pattern
+
+class SRXRules:
+    """Parsed SRX file: rule lists per language rule name, and the
+    language map."""
+
+    def __init__(self, path):
+        root = ET.parse(path).getroot()
+        header = [e for e in root.iter() if _tag(e) == 'header']
+        self.cascade = header[0].get('cascade','no') == 'yes' if header else False
+        self.languagerules = {}
+        self.maprules = []
+        for lr in [e for e in root.iter() if _tag(e) == 'languagerule']:
+            rules = []
+            for r in _children(lr,'rule'):
+                before = _children(r,'beforebreak')
+                after  = _children(r,'afterbreak')
+                # whitespace in a pattern is significant: use it as is
+                before = (before[0].text or '') if before else ''
+                after  = (after[0].text or '') if after else ''
+                rules.append((r.get('break','yes') != 'no', before, after))
+                pass
+            self.languagerules[lr.get('languagerulename')] = rules
+            pass
+        for lm in [e for e in root.iter() if _tag(e) == 'languagemap']:
+            self.maprules.append((regex.compile(lm.get('languagepattern')),
+                                  lm.get('languagerulename')))
+            pass
+        return
+
+    def rules_for(self, lang):
+        """All rules applicable to language /lang/, in order."""
+        rules = []
+        for pattern, name in self.maprules:
+            if pattern.match(lang):
+                rules.extend(self.languagerules.get(name, []))
+                if not self.cascade:
+                    break
+                pass
+            pass
+        return rules
+    pass
+
+# SRX files are parsed only once per process
+_srx_cache = {}
+_srx_cache_lock = threading.Lock()
+
+def load_rules(path):
+    with _srx_cache_lock:
+        if path not in _srx_cache:
+            logger.info("Loading SRX rules from %s"%path)
+            _srx_cache[path] = SRXRules(path)
+            pass
+        return _srx_cache[path]
+
+def _compile_rule(before, after):
+    parts = []
+    if before: parts.append("(?<=%s)"%_scope_flags(before))
+    if after:  parts.append("(?=%s)"%_scope_flags(after))
+    return "".join(parts)
+
+class SRXSplitter:
+    def __init__(self, lang, rules):
+        self.lang = lang
+        alternatives = []
+        breaks = []
+        for i, (is_break, before, after) in enumerate(load_rules(rules).rules_for(lang)):
+            pattern = _compile_rule(before, after)
+            try:
+                regex.compile(pattern)
+            except regex.error as e:
+                logger.warning("Skipping SRX rule #%d for %s (%s): %s"
+                               %(i, lang, e, pattern))
+                continue
+            alternatives.append("%s(?P<%s%d>)"%(pattern, 'b' if is_break else 'n', i))
+            if is_break: breaks.append(pattern)
+            pass
+        if not breaks:
+            logger.warning("No SRX break rules for language '%s'."%lang)
+        self.candidates = regex.compile("|".join(breaks)) if breaks else None
+        self.decide = regex.compile("|".join(alternatives)) if breaks else None
+        return
+
+    def break_positions(self, text):
+        if self.candidates is None:
+            return
+        last = -1
+        for m in self.candidates.finditer(text, overlapped=True):
+            p = m.start()
+            if p == last or p == 0 or p == len(text):
+                continue
+            last = p
+            d = self.decide.match(text, p)
+            if d and d.lastgroup[0] == 'b':
+                yield p
+            pass
+        return
+
+    def __call__(self, text):
+        text = regex.sub(r'\s+', ' ', text).strip()
+        ret = []
+        start = 0
+        for p in self.break_positions(text):
+            s = text[start:p].strip()
+            if len(s): ret.append(s)
+            start = p
+            pass
+        s = text[start:].strip()
+        if len(s): ret.append(s)
+        return ret
+    pass # end of class definition
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    p = ArgumentParser()
+    p.add_argument("-l", dest="lang", default='en', help="language")
+    p.add_argument("-r", dest="rules", required=True, help="SRX rules file")
+    opts = p.parse_args()
+    ssplit = SRXSplitter(opts.lang, opts.rules)
+    for line in sys.stdin:
+        print('\n'.join(ssplit(line)), end='\n\n', flush=True)
+        pass
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Persistent translation memory: translations of preprocessed sentences,
+stored in an sqlite database keyed by model fingerprint and source
+sentence. Sqlite in WAL mode allows all worker processes on a node to
+share one database file, and it survives restarts.
+"""
+
+import sqlite3, threading, logging
+
+logger = logging.getLogger(__name__)
+
+class TranslationMemory:
+    def __init__(self, path, model_id):
+        self.path = path
+        self.model_id = model_id
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tm "
+                            "(model TEXT, source TEXT, translation TEXT, "
+                            "PRIMARY KEY (model, source)) WITHOUT ROWID")
+            pass
+        logger.info("Using translation memory at %s"%path)
+        return
+
+    def get(self, source):
+        with self.lock:
+            row = self.db.execute("SELECT translation FROM tm "
+                                  "WHERE model = ? AND source = ?",
+                                  (self.model_id, source)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put_many(self, pairs):
+        """Store (source, translation) pairs in a single transaction."""
+        pairs = [(self.model_id, s, t) for s,t in pairs]
+        if not len(pairs):
+            return
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.executemany("INSERT OR REPLACE INTO tm "
+                                        "VALUES (?, ?, ?)", pairs)
+            except sqlite3.OperationalError as e:
+                # e.g. database locked for too long; not worth failing for
+                logger.warning("Could not update translation memory: %s"%e)
+                pass
+            pass
+        return
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+        return
+    pass # end of class definition
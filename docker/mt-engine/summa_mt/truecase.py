@@ -2,10 +2,114 @@
 """
 Simple re-implementation of truecase.perl.
 Currently doesn't handle XML.
+
+The model is looked up in a compact memory-mapped lexicon (.lex, see
+mmap_table.py) if there is one, otherwise in a .dbm file (the old format).
+If neither exists, the .lex file is built from the text model; building
+large models takes a while, so it can also be done explicitly:
+
+  ./truecase.py --build -j 8 truecase-model.de
 """
 
-import sys, os, dbm, shelve
+import sys, os, io, dbm, shelve, time, logging, multiprocessing, threading
 from collections import defaultdict
+from mmap_table import MMapTable, build
+
+logger = logging.getLogger(__name__)
+
+def model_base(model):
+    """Path of the text model, given the path of the model or a lexicon."""
+    return model[:-4] if model[-4:] in [".dbm",".lex"] else model
+
+def needs_build(model):
+    """True if there is no lexicon for /model/ yet."""
+    model = model_base(model)
+    return not (os.path.exists(model+".lex") or os.path.exists(model+".dbm"))
+
+def _read_chunk(job):
+    path, start, end = job
+    with open(path,'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf8')
+        pass
+    table = {}
+    for line in io.StringIO(text, newline=None):
+        x = line.strip().split(' ')
+        for i in range(0,len(x),2):
+            table[x[i]] = ""
+            pass
+        table[x[0].lower()] = x[0]
+        pass
+    return table
+
+def _chunks(path, n):
+    """Split file /path/ into (up to) /n/ chunks of whole lines."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path,'rb') as f:
+        for i in range(1,n):
+            f.seek(max(bounds[-1], size * i // n))
+            f.readline()
+            if f.tell() >= size: break
+            if f.tell() > bounds[-1]: bounds.append(f.tell())
+            pass
+        pass
+    bounds.append(size)
+    return [(path, a, b) for a,b in zip(bounds,bounds[1:])]
+
+def read_model(path, processes=1):
+    """
+    Read a text truecasing model (as produced by Moses' train-truecaser.perl)
+    into a dict: every known form maps to '', except the lowercased form of
+    the first (most frequent) form on each line, which maps to the latter.
+    With processes > 1, chunks of the file are parsed in parallel; the
+    results are merged in file order, so later lines win as before.
+    """
+    if processes <= 1:
+        return _read_chunk((path, 0, os.path.getsize(path)))
+    chunks = _chunks(path, 4 * processes)
+    table = {}
+    reported = 0
+    with multiprocessing.Pool(processes) as pool:
+        for i, t in enumerate(pool.imap(_read_chunk, chunks)):
+            table.update(t)
+            done = 100 * (i + 1) // len(chunks)
+            if done >= reported + 10:
+                logger.info("Truecasing model %s: %d%% read"%(path, done))
+                reported = done
+            pass
+        pass
+    return table
+
+def build_lexicon(model, processes=0):
+    """Build the lexicon <model>.lex from the text model, reading it with
+    /processes/ processes (0: one per CPU). The file appears atomically."""
+    model = model_base(model)
+    start = time.time()
+    logger.info("Building truecasing lexicon %s.lex"%model)
+    table = read_model(model, processes or multiprocessing.cpu_count())
+    build(table, model+".lex")
+    logger.info("Built truecasing lexicon %s.lex (%d entries) in %.1f sec."
+                %(model, len(table), time.time() - start))
+    return model+".lex"
+
+class DbmLexicon:
+    """Truecasing lexicon in a dbm file. Lookups are serialized, since dbm
+    handles must not be used by several threads at once."""
+    def __init__(self, path):
+        self.db = dbm.open(path,'r')
+        self.lock = threading.Lock()
+        return
+
+    def __contains__(self, w):
+        with self.lock:
+            return w in self.db
+
+    def get(self, w, default=None):
+        with self.lock:
+            x = self.db.get(w)
+        return default if x is None else x.decode('utf8')
+    pass
 
 class Truecaser:
 
@@ -19,24 +123,14 @@ class Truecaser:
         return
 
     def load_model(self,model):
-        if model[-4:] == ".dbm":
-            model = model[:-4]
-            pass
-    
-        if os.path.exists(model+".dbm"):
-            self.db = dbm.open(model+".dbm",'r')
-            return
-    
-        self.db = dbm.open(model+".dbm",'c')
-        for line in open(model):
-            x = line.strip().split(' ')
-            for i in range(0,len(x),2):
-                self.db[x[i]] = ""
-                pass
-            self.db[x[0].lower()] = x[0]
+        model = model_base(model)
+        if os.path.exists(model+".lex"):
+            self.db = MMapTable(model+".lex")
+        elif os.path.exists(model+".dbm"):
+            self.db = DbmLexicon(model+".dbm")
+        else:
+            self.db = MMapTable(build_lexicon(model))
             pass
-        self.db.close() # make sure things get written to disk
-        self.db = dbm.open(model+".dbm",'r')
         return 
 
     def __call__(self,line,asr=False):
@@ -46,7 +140,7 @@ class Truecaser:
             if sos or asr or w not in self.db:
                 # At the start of a sentence or when dealing with ASR output,
                 # always use the most frequent form:
-                x = self.db.get(w.lower(),b'').decode('utf8')
+                x = self.db.get(w.lower(),'')
                 ret.append(x if len(x) else w)
             else: ret.append(w)
             if w in self.sentence_end:
@@ -62,12 +156,20 @@ class Truecaser:
     pass
 
 if __name__ == "__main__":
-    truecase = Truecaser(sys.argv[1])
+    from argparse import ArgumentParser
+    p = ArgumentParser()
+    p.add_argument("model", help="truecasing model")
+    p.add_argument("--build", action='store_true',
+                   help="only build the lexicon for the model")
+    p.add_argument("-j", dest="processes", type=int, default=0,
+                   help="number of processes for building the lexicon "
+                   "(default: one per CPU)")
+    opts = p.parse_args()
+    logging.basicConfig(level='INFO',format="%(levelname)s %(message)s")
+    if opts.build:
+        build_lexicon(opts.model, opts.processes)
+        sys.exit(0)
+    truecase = Truecaser(opts.model)
     for line in sys.stdin:
         print(truecase(line,asr=True))
         pass
-    
-    
-    
-
-
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import logging, pika, regex, sys, os, json, copy, yaml
+import logging, pika, regex, sys, os, json, yaml
 import threading, time
 
 name = 'SUMMA-MT' # required for responses
@@ -9,12 +9,29 @@ logger = logging.getLogger(__name__)
 mydir = os.path.dirname(__file__)
 sys.path.insert(1, os.path.join(mydir,"summa_mt"))
 
-from marian import Translator
-import marian
+# marian is imported only where it's needed, because importing it fails
+# where there is no marian-server executable (e.g. for benchmark.py).
 
 def setup_argparser(ap):
+    import marian
     if hasattr(marian,"setup_argparser"):
         marian.setup_argparser(ap)
+    ap.add_argument("--batch-max-wait", type=float,
+                    default=os.environ.get('MT_BATCH_MAX_WAIT',0),
+                    help="Collect sentences from several messages for up to "
+                    "this many seconds and translate them together (0: "
+                    "translate each message on its own). Requires a "
+                    "prefetch count > 1; ignored with --pipeline-depth.")
+    ap.add_argument("--batch-max-tokens", type=int,
+                    default=os.environ.get('MT_BATCH_MAX_TOKENS',2000),
+                    help="Translate collected sentences right away once they "
+                    "have this many tokens.")
+    ap.add_argument("--partial-results", type=int,
+                    default=os.environ.get('MT_PARTIAL_RESULTS',0),
+                    help="While a document is being translated, publish the "
+                    "translations of every (at least) this many sentences "
+                    "as partialResult messages (0: only the final result). "
+                    "Not supported with --pipeline-depth or --batch-max-wait.")
     return
 
 def encode_sentence(s):
@@ -22,49 +39,203 @@ def encode_sentence(s):
              [ {'token': { 'offset' : i, 'token': w }, 'features' : [] }
                for i,w in enumerate(s.strip().split()) ] }
 
+def encode_tokens(s):
+    """Compact alternative to encode_sentence: the tokens as plain strings
+    (their offsets are their positions, there are no features)."""
+    return { 'tokens' : s.strip().split() }
+
+# token formats a requester can ask for (header acceptTokenFormat)
+SENTENCE_ENCODERS = { 'dict' : encode_sentence, 'array' : encode_tokens }
+
 ptag = regex.compile(r'^</?[pP]>$')
 
 def extract_text(blob):
-    tokens = [ x['token']['token'] for x in blob['tokens'] ]
     paragraphs = [[]]
-    for t in tokens:
-        if ptag.match(t):
+    for x in blob['tokens']:
+        t = x['token']['token']
+        if t[:1] == '<' and ptag.match(t):
             if len(paragraphs[-1]): paragraphs.append([])
         else:
             paragraphs[-1].append(t)
         pass
     return [" ".join(p) for p in paragraphs]
 
+def source_text(instance):
+    """The paragraphs of an instance as strings."""
+    return [p for blob in instance['body']['sentences'] for p in extract_text(blob)]
+
+def new_instance(instance):
+    """A copy of /instance/ to hold its translation. Only the instance and
+    its body are copied (the caller replaces the body's sentences); the
+    metadata and everything else are shared with the original."""
+    return dict(instance, body=dict(instance['body']))
+
+def encode_translation(translated, token_format=None):
+    """Encode postprocessed translations (strings or lists of strings)."""
+    encode = SENTENCE_ENCODERS.get(token_format, encode_sentence)
+    ready = []
+    for t in translated:
+        if type(t).__name__ == 'str':
+            ready.append(encode(t))
+        else:
+            ready.extend([encode(s) for s in t])
+            pass
+        pass
+    return ready
+
 class DocumentTranslator(object):
 
-    def __init__(self, opts):
+    def __init__(self, opts, translator=None):
         #mpath = getattr(opts,'model','model')
-        self.translate = Translator(opts)
+        if translator is None:
+            from marian import Translator
+            translator = Translator(opts)
+        self.translate = translator
         self.trglang = self.translate.trglang
+        self.part_size = getattr(opts,'partial_results',0)
         return
 
-    def __call__(self,document):
-        jobs = [copy.deepcopy(i) for i in document['instances']
-                if i['metadata']['language'] == self.trglang]
-        for j in jobs:
-            pars = [extract_text(s) for s in j['body']['sentences']]
-            sents = [s for p in pars for s in p]
-            ready = []
-            # for i in range(len(sents)):
-            #     logger.info("[%d] %s"%(i,sents[i]))
-            translated = self.translate(sents)
-            for t in translated:
-                # logger.info(t)
-                if type(t).__name__ == 'str':
-                    ready.append(encode_sentence(t))
-                else:
-                    ready.extend([encode_sentence(s) for s in t])
+    def __call__(self,document,on_partial=None,token_format=None):
+        """
+        Translate /document/. If /on_partial/ is given (and partial results
+        are enabled), it is called as on_partial(instance, offset, sentences)
+        whenever the next part of an instance has been translated, with the
+        encoded translated sentences starting at position /offset/.
+        /token_format/ is a key of SENTENCE_ENCODERS (default: 'dict').
+        Returns a new document that shares the original instances.
+        """
+        jobs = []
+        for i in self.instances_to_translate(document):
+            sents = source_text(i)
+            j = new_instance(i)
+            if on_partial and self.part_size:
+                ready = []
+                for part in self.translate.translate_in_parts(sents, self.part_size):
+                    part = encode_translation(part, token_format)
+                    on_partial(j, len(ready), part)
+                    ready.extend(part)
                     pass
-                pass
+            else:
+                ready = encode_translation(self.translate(sents), token_format)
             j['body']['sentences'] = ready
+            jobs.append(j)
+            pass
+        return dict(document, instances=document['instances'] + jobs)
+
+    def instances_to_translate(self,document):
+        return [i for i in document['instances']
+                if i['metadata']['language'] == self.trglang]
+
+    def prepare(self,document):
+        """
+        First half of __call__, for translation in batches shared with
+        other documents: find the instances to be translated and preprocess
+        their text. Returns the preprocessed sentences of each instance.
+        """
+        jobs, sources = [], []
+        for i in self.instances_to_translate(document):
+            sources.append(self.translate.preprocess_text(source_text(i)))
+            jobs.append(new_instance(i))
             pass
-        document['instances'].extend(jobs)
-        return document
+        return jobs, sources
+
+    def decode(self,prepared):
+        """Translate the preprocessed sentences returned by prepare()."""
+        jobs, sources = prepared
+        return jobs, [self.translate.decode(s) for s in sources]
+
+    def stages(self):
+        """Stages for a pipeline.StagedPipeline that translates documents;
+        its items are (document, token format) pairs."""
+        def prepare(item):
+            return item, self.prepare(item[0])
+        def decode(x):
+            return x[0], self.decode(x[1])
+        def finish(x):
+            (document, token_format), (jobs, translations) = x
+            return self.finish(document, jobs, translations, token_format)
+        return [("preprocess", prepare), ("decode", decode),
+                ("postprocess", finish)]
+
+    def finish(self,document,jobs,translations,token_format=None):
+        """Second half of __call__: postprocess the (raw) translations of
+        the instances returned by prepare() and add them to the document."""
+        for j,t in zip(jobs,translations):
+            j['body']['sentences'] = encode_translation\
+                                     (self.translate.postprocess(t), token_format)
+            pass
+        return dict(document, instances=document['instances'] + jobs)
+    pass
+
+class MicroBatcher(object):
+    """
+    Collects the preprocessed sentences of several documents and sends them
+    to marian together, so that short documents don't leave marian idle.
+    The owner calls flush() when max_wait has passed since the first
+    sentences were added, or right away when add() says that the batch has
+    reached max_tokens. Each document's on_done callback then receives its
+    share of the translations, or its on_error callback the exception if
+    the batch (or its own on_done) failed.
+
+    flush() is take() followed by run(); an owner with an event loop calls
+    take() on the loop and run() in a worker thread.
+    """
+    def __init__(self, decode, max_wait=0.05, max_tokens=2000):
+        self.decode = decode
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.pending = [] # (sentences per job, on_done, on_error)
+        self.tokens = 0
+        return
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, sources, on_done, on_error):
+        """Add a document's sentences (a list of lists, one per instance).
+        Returns True if the batch is full and should be flushed."""
+        self.pending.append((sources, on_done, on_error))
+        self.tokens += sum(len(s.split()) for job in sources for s in job)
+        return self.tokens >= self.max_tokens
+
+    def take(self):
+        """Remove the pending documents from the batcher and return them."""
+        pending, self.pending, self.tokens = self.pending, [], 0
+        return pending
+
+    def run(self, pending):
+        """Translate documents returned by take()."""
+        if not pending:
+            return
+        sentences = [s for sources,_,_ in pending for job in sources for s in job]
+        start = time.time()
+        try:
+            translation = self.decode(sentences)
+        except Exception as e:
+            for sources, on_done, on_error in pending:
+                on_error(e)
+                pass
+            return
+        logger.info("Translated %d sentences from %d messages in %.2f sec."
+                    %(len(sentences), len(pending), time.time() - start))
+        k = 0
+        for sources, on_done, on_error in pending:
+            result = []
+            for job in sources:
+                result.append(translation[k:k+len(job)])
+                k += len(job)
+                pass
+            try:
+                on_done(result)
+            except Exception as e:
+                on_error(e)
+                pass
+            pass
+        return
+
+    def flush(self):
+        self.run(self.take())
+        return
     pass
 
 class MessageHandler(object):
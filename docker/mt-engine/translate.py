@@ -5,6 +5,7 @@ logger = logging.getLogger(__name__)
 mydir = os.path.dirname(__file__)
 sys.path.insert(1, os.path.join(mydir,"summa_mt"))
 from marian import Translator
+from pipeline import StagedPipeline, translation_stages
 from argparse import ArgumentParser
 import marian
 
@@ -16,25 +17,38 @@ def parse_arguments(args=sys.argv[1:]):
         marian.setup_argparser(p)
     return p.parse_args()
     
+def translate_sequentially(translate, lines):
+    for line in lines:
+        logger.info("IN: %s"%line)
+        if line.strip() == '': yield line, None
+        else: yield line, translate(line)
+        pass
+    return
+
 if __name__ == "__main__":
     opts = parse_arguments()
     logging.basicConfig(level=opts.verbose,format="%(levelname)s %(message)s")
     translate = Translator(opts)
+    pipeline = None
+    if getattr(opts,'pipeline_depth',0):
+        pipeline = StagedPipeline(translation_stages(translate),
+                                  opts.pipeline_depth)
+        translations = pipeline.map(sys.stdin, skip=lambda x: x.strip() == '')
+    else:
+        translations = translate_sequentially(translate, sys.stdin)
+        pass
     try:
-        for line in sys.stdin:
-            logger.info("IN: %s"%line)
-            if line.strip() == '': print()
+        for line, translation in translations:
+            if translation is None: print()
+            elif type(translation).__name__ == 'str':
+                print(translation.strip())
             else:
-                translation = translate(line)
-                if type(translation).__name__ == 'str':
-                    print(translation.strip())
-                else:
-                    for line in translation:
-                        print(line)
-                        pass
+                for line in translation:
+                    print(line)
                     pass
                 pass
             pass
+        if pipeline: pipeline.close()
     except KeyboardInterrupt:
         translate.stop()
         sys.exit(0)
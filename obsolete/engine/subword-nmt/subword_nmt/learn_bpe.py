@@ -18,9 +18,10 @@ import sys
 import inspect
 import codecs
 import re
-import copy
 import argparse
 import warnings
+import multiprocessing
+from heapq import heapify, heappush, heappop
 from collections import defaultdict, Counter
 
 # hack for python2/3 compatibility
@@ -58,15 +59,40 @@ def create_parser(subparsers=None):
     parser.add_argument(
         '--total-symbols', '-t', action="store_true",
         help="subtract number of characters from the symbols to be generated (so that '--symbols' becomes an estimate for the total number of symbols needed to encode text).")
+    parser.add_argument(
+        '--num-workers', type=int, default=1, metavar='N',
+        help="Count word frequencies in N processes, each reading one shard of the input file (default: %(default)s)")
+    parser.add_argument(
+        '--resume', type=argparse.FileType('r'), default=None,
+        metavar='PATH',
+        help="BPE codes written by an interrupted run with the same input; these merges are replayed before learning continues. " +
+             "Use a copy: the file given with '--output' is overwritten.")
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
 
     return parser
 
-def get_vocabulary(fobj, is_dict=False):
+def get_vocabulary(fobj, is_dict=False, num_workers=1):
     """Read text and return dictionary that encodes vocabulary
+
+    With num_workers > 1, a text that is a regular file is split into
+    shards of roughly equal size that are counted in parallel.
     """
+    if num_workers > 1 and not is_dict:
+        shards = _get_shards(fobj, num_workers)
+        if shards:
+            vocab = Counter()
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                # merge in input order, so that the result is the same as counting sequentially
+                for counts in pool.imap(_count_shard, shards):
+                    vocab.update(counts)
+            finally:
+                pool.close()
+                pool.join()
+            return vocab
+
     vocab = Counter()
     for i, line in enumerate(fobj):
         if is_dict:
@@ -82,6 +108,40 @@ def get_vocabulary(fobj, is_dict=False):
                     vocab[word] += 1
     return vocab
 
+def _get_shards(fobj, num_shards):
+    """Split the file behind fobj into byte ranges (path, start, end); None if fobj is not a regular file"""
+    path = getattr(fobj, 'name', None)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    bounds = [size * k // num_shards for k in range(num_shards + 1)]
+    return [(path, start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _count_shard(shard):
+    """Count the words of the lines that start within a byte range of a UTF-8 text file"""
+    path, start, end = shard
+    vocab = Counter()
+    with open(path, 'rb') as f:
+        # a line belongs to the shard in which it starts
+        if start:
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            # codecs readers (as used by the sequential path) also break lines at
+            # Unicode line boundaries, so split the same way
+            for subline in line.decode('utf-8').splitlines(True):
+                for word in subline.strip('\r\n ').split(' '):
+                    if word:
+                        vocab[word] += 1
+    return vocab
+
+
 def update_pair_statistics(pair, changed, stats, indices):
     """Minimally update the indices and frequency of symbol pairs
 
@@ -184,6 +244,72 @@ def replace_pair(pair, vocab, indices):
 
     return changes
 
+class PairStatistics(defaultdict):
+    """Frequencies of symbol pairs (a defaultdict(int)) that keeps track of
+    the pairs whose frequency has been set since the last call of pop_changed()
+    """
+
+    def __init__(self, stats):
+        defaultdict.__init__(self, int, stats)
+        self.changed = set()
+
+    def __setitem__(self, pair, freq):
+        defaultdict.__setitem__(self, pair, freq)
+        self.changed.add(pair)
+
+    def pop_changed(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+
+class _Descending(object):
+    """Wrapper that reverses the order of symbol pairs in a heap"""
+    __slots__ = ('pair',)
+
+    def __init__(self, pair):
+        self.pair = pair
+
+    def __lt__(self, other):
+        return self.pair > other.pair
+
+
+class PairQueue(object):
+    """Priority queue over PairStatistics: heap with lazy invalidation
+
+    top() returns the same pair as max(stats, key=lambda x: (stats[x], x)),
+    i.e. the most frequent pair, ties broken in favour of the largest pair.
+    Instead of updating heap entries in place, a new entry is pushed whenever
+    the frequency of a pair changes; entries that no longer match the current
+    frequency are discarded when they reach the top.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._rebuild()
+
+    def _rebuild(self):
+        self.stats.pop_changed()
+        self.heap = [(-freq, _Descending(pair)) for pair, freq in self.stats.items()]
+        heapify(self.heap)
+
+    def top(self):
+        """Most frequent pair, or None if there are no pairs"""
+        stats, heap = self.stats, self.heap
+        for pair in stats.pop_changed():
+            heappush(heap, (-stats[pair], _Descending(pair)))
+        # drop outdated entries if they dominate the heap
+        if len(heap) > 2 * len(stats) + 100000:
+            self._rebuild()
+            heap = self.heap
+        while heap:
+            freq, key = heap[0]
+            if stats.get(key.pair) == -freq:
+                return key.pair
+            heappop(heap)
+        return None
+
+
 def prune_stats(stats, big_stats, threshold):
     """Prune statistics dict for efficiency of max()
 
@@ -200,20 +326,23 @@ def prune_stats(stats, big_stats, threshold):
                 big_stats[item] = freq
 
 
-def learn_bpe(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False, total_symbols=False):
+def learn_bpe(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False, total_symbols=False, num_workers=1, resume=None):
     """Learn num_symbols BPE operations from vocabulary, and write to outfile.
+
+    resume: BPE codes (file or list of lines) learned from the same input by an
+    interrupted run; they count towards num_symbols and are written to outfile first.
     """
 
     # version 0.2 changes the handling of the end-of-word token ('</w>');
     # version numbering allows bckward compatibility
     outfile.write('#version: 0.2\n')
 
-    vocab = get_vocabulary(infile, is_dict)
+    vocab = get_vocabulary(infile, is_dict, num_workers)
     vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
     sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
 
     stats, indices = get_pair_statistics(sorted_vocab)
-    big_stats = copy.deepcopy(stats)
+    stats = PairStatistics(stats)
 
     if total_symbols:
         uniq_char_internal = set()
@@ -227,22 +356,34 @@ def learn_bpe(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_d
         sys.stderr.write('Reducing number of merge operations by {0}\n'.format(len(uniq_char_internal) + len(uniq_char_final)))
         num_symbols -= len(uniq_char_internal) + len(uniq_char_final)
 
-    # threshold is inspired by Zipfian assumption, but should only affect speed
-    threshold = max(stats.values()) / 10
-    for i in range(num_symbols):
-        if stats:
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
-
-        # we probably missed the best pair because of pruning; go back to full statistics
-        if not stats or (i and stats[most_frequent] < threshold):
-            prune_stats(stats, big_stats, threshold)
-            stats = copy.deepcopy(big_stats)
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
-            # threshold is inspired by Zipfian assumption, but should only affect speed
-            threshold = stats[most_frequent] * i/(i+10000.0)
-            prune_stats(stats, big_stats, threshold)
-
-        if stats[most_frequent] < min_frequency:
+    i = 0
+    if resume is not None:
+        for line in resume:
+            if line.startswith('#version:'):
+                if line.split()[-1] != '0.2':
+                    sys.stderr.write('Cannot resume from BPE codes of version {0}\n'.format(line.split()[-1]))
+                    sys.exit(1)
+                continue
+            if i >= num_symbols:
+                break
+            pair = tuple(line.strip('\r\n ').split(' '))
+            if len(pair) != 2:
+                sys.stderr.write('Failed reading BPE codes to resume from at line {0}: {1}\n'.format(i, line))
+                sys.exit(1)
+            if not stats.get(pair):
+                sys.stderr.write('Warning: pair {0} {1} to resume from does not occur in the input\n'.format(*pair))
+            outfile.write('{0} {1}\n'.format(*pair))
+            changes = replace_pair(pair, sorted_vocab, indices)
+            update_pair_statistics(pair, changes, stats, indices)
+            stats[pair] = 0
+            i += 1
+        sys.stderr.write('Resuming after {0} merge operations\n'.format(i))
+
+    queue = PairQueue(stats)
+    for i in range(i, num_symbols):
+        most_frequent = queue.top()
+
+        if most_frequent is None or stats[most_frequent] < min_frequency:
             sys.stderr.write('no pair has frequency >= {0}. Stopping\n'.format(min_frequency))
             break
 
@@ -252,8 +393,9 @@ def learn_bpe(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_d
         changes = replace_pair(most_frequent, sorted_vocab, indices)
         update_pair_statistics(most_frequent, changes, stats, indices)
         stats[most_frequent] = 0
-        if not i % 100:
-            prune_stats(stats, big_stats, threshold)
+        # keep the codes learned so far on disk, for resuming an interrupted run
+        if not i % 1000:
+            outfile.flush()
 
 
 if __name__ == '__main__':
@@ -286,4 +428,8 @@ if __name__ == '__main__':
     if args.output.name != '<stdout>':
         args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
 
-    learn_bpe(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input, total_symbols=args.total_symbols)
+    if args.resume is not None:
+        # only split at '\n': symbols may contain other Unicode line boundaries
+        args.resume = open(args.resume.name, encoding='utf-8', newline='\n')
+
+    learn_bpe(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input, total_symbols=args.total_symbols, num_workers=args.num_workers, resume=args.resume)
@@ -45,7 +45,11 @@ learn-joint-bpe-and-vocab: executes recommended workflow for joint BPE.""")
         if args.output.name != '<stdout>':
             args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
 
-        learn_bpe(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input)
+        if args.resume is not None:
+            # only split at '\n': symbols may contain other Unicode line boundaries
+            args.resume = io.open(args.resume.name, encoding='utf-8', newline='\n')
+
+        learn_bpe(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input, num_workers=args.num_workers, resume=args.resume)
     elif args.command == 'apply-bpe':
         # read/write files as UTF-8
         args.codes = codecs.open(args.codes.name, encoding='utf-8')
@@ -2,6 +2,9 @@
 
 import sys, os, yaml, dbm, shutil
 
+mydir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, os.path.join(mydir,"..","docker","mt-engine","summa_mt"))
+
 def repl_vars(spec,variables):
     """Replace variables in specification."""
     if type(spec) is str:
@@ -85,6 +88,40 @@ def tc2dbm(src,trg,dryrun=False):
         os.rename(trg+"_",trg)
     return
 
+def tc2lex(src,trg,dryrun=False):
+    """convert text-based truecase model to a memory-mapped lexicon (.lex)."""
+    if dryrun:
+        print("Convert %s to %s"%(src,trg))
+    elif os.path.exists(trg):
+        print("Skipping convertion of %s to %s: "
+              "target file exists"%(src,trg))
+    else:
+        import truecase, mmap_table
+        table = truecase.read_model(src, os.cpu_count())
+        mmap_table.build(table, trg) # writes atomically
+        pass
+    return
+
+def compile_bpe(step,dryrun=False):
+    """precompile BPE codes and vocabulary into memory-mapped tables (.bin)."""
+    import apply_bpe, codecs
+    merges = int(str(step.get('merges','-1')).replace('K','000'))
+    jobs = [(step['codes'], lambda f,trg: apply_bpe.compile_codes(f,trg,merges))]
+    if step.get('vocabulary'):
+        jobs.append((step['vocabulary'], apply_bpe.compile_vocabulary))
+    for name, compile in jobs:
+        src, trg = verify_file(name), dest%(name+".bin")
+        if dryrun:
+            print("Compile %s to %s"%(src,trg))
+        elif os.path.exists(trg) and not opts.force:
+            print("Skipping %s: target file exists."%trg,file=sys.stderr)
+        else:
+            compile(codecs.open(src,encoding='utf8'),trg)
+            pass
+        files.append(name+".bin")
+        pass
+    return
+
 def copy_file(src,trg, dryrun=False, force=False):
     if dryrun:
         print("Copy %s to %s"%(src,trg))
@@ -128,11 +165,15 @@ if prepro:
         if action == 'truecase':
             trg = step['model']
             src = verify_file(trg)
-            tc2dbm(src,dest%trg,opts.dryrun)
+            if trg.endswith(".lex"):
+                tc2lex(src,dest%trg,opts.dryrun)
+            else:
+                tc2dbm(src,dest%trg,opts.dryrun)
             files.append(trg)
         elif action == "bpe":
             provision(step['codes'])
             provision(step.get('vocabulary'))
+            compile_bpe(step,opts.dryrun)
         pass
     dump_yml(prepro, "preprocess.yml", opts.dryrun, opts.force)
     pass